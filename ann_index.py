@@ -0,0 +1,333 @@
+"""
+Approximate nearest-neighbour index for large galleries (pure NumPy).
+
+IVF layout: k-means centroids split the gallery into inverted lists. A query
+scans only the `nprobe` lists whose centroids are closest and re-ranks those
+candidates with exact distances, so cost grows with nprobe * list size
+instead of the whole gallery. Raising nprobe trades latency for recall.
+
+Entries are keyed by the gallery's per-row image path, which is stable across
+syncs, so a new gallery only adds and removes the rows that changed.
+
+Usage:
+    python ann_index.py --gallery gallery.bin --nprobe 1 2 4 8 16 --top-k 1 3 5
+"""
+
+import argparse
+import os
+import secrets
+import time
+
+import numpy as np
+
+from face_matcher import (
+    ENCODING_DIM, FaceMatcher, PrototypeMatcher, as_encoding_matrix, distance_to_confidence, measure_agreement
+)
+
+
+def _sq_distances(queries, q_sq, points, p_sq):
+    sq = queries @ points.T
+    sq *= -2.0
+    sq += q_sq[:, None]
+    sq += p_sq[None, :]
+    np.maximum(sq, 0.0, out=sq)
+    return sq
+
+
+def _nearest_centroid(matrix, centroids, c_sq, chunk=4096):
+    """Index of the nearest centroid for every row, in bounded-memory chunks"""
+    out = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), chunk):
+        block = np.asarray(matrix[start:start + chunk], dtype=np.float32)
+        b_sq = np.einsum('ij,ij->i', block, block)
+        out[start:start + chunk] = np.argmin(_sq_distances(block, b_sq, centroids, c_sq), axis=1)
+    return out
+
+
+def kmeans(matrix, k, iters=10, sample=50000, seed=0):
+    """Plain Lloyd's k-means on (a sample of) the gallery"""
+    rng = np.random.default_rng(seed)
+    if len(matrix) > sample:
+        matrix = matrix[np.sort(rng.choice(len(matrix), sample, replace=False))]
+    data = as_encoding_matrix(matrix)
+    k = max(1, min(k, len(data)))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iters):
+        c_sq = np.einsum('ij,ij->i', centroids, centroids)
+        assign = _nearest_centroid(data, centroids, c_sq)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty lists on random points so no centroid is wasted
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids
+
+
+class _InvertedList:
+    """Growable block of vectors belonging to one centroid"""
+
+    def __init__(self):
+        self.vectors = np.empty((0, ENCODING_DIM), dtype=np.float32)
+        self.sq_norms = np.empty(0, dtype=np.float32)
+        self.keys = []
+        self.names = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, key, vector, name):
+        size = len(self.keys)
+        if size == len(self.vectors):
+            capacity = max(8, size * 2)
+            vectors = np.empty((capacity, ENCODING_DIM), dtype=np.float32)
+            vectors[:size] = self.vectors[:size]
+            sq_norms = np.empty(capacity, dtype=np.float32)
+            sq_norms[:size] = self.sq_norms[:size]
+            self.vectors, self.sq_norms = vectors, sq_norms
+        self.vectors[size] = vector
+        self.sq_norms[size] = float(np.dot(self.vectors[size], self.vectors[size]))
+        self.keys.append(key)
+        self.names.append(name)
+        return size
+
+    def pop_slot(self, slot):
+        """Remove by swapping the last entry into `slot`; returns the moved key or None"""
+        last = len(self.keys) - 1
+        moved = None
+        if slot != last:
+            self.vectors[slot] = self.vectors[last]
+            self.sq_norms[slot] = self.sq_norms[last]
+            self.keys[slot] = self.keys[last]
+            self.names[slot] = self.names[last]
+            moved = self.keys[slot]
+        self.keys.pop()
+        self.names.pop()
+        return moved
+
+
+class IVFIndex:
+    """Inverted-file ANN index with exact re-ranking of the probed lists"""
+
+    def __init__(self, centroids, nprobe=8, trained_size=0):
+        self.centroids = as_encoding_matrix(centroids)
+        self.c_sq = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.nprobe = nprobe
+        self.trained_size = trained_size
+        self.lists = [_InvertedList() for _ in range(len(self.centroids))]
+        self.where = {}       # key -> (list number, slot)
+        self._assignments = {}  # key -> list number restored by load()
+
+    @classmethod
+    def train(cls, matrix, n_lists=None, nprobe=8, iters=10, seed=0):
+        if n_lists is None:
+            # ~4 sqrt(N) lists keeps lists small without too many centroids
+            n_lists = max(1, int(4 * np.sqrt(len(matrix))))
+        return cls(kmeans(matrix, n_lists, iters=iters, seed=seed), nprobe=nprobe, trained_size=len(matrix))
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, keys, vectors, names):
+        vectors = as_encoding_matrix(vectors)
+        missing = [i for i, key in enumerate(keys) if key not in self._assignments]
+        assign = {}
+        if missing:
+            nearest = _nearest_centroid(vectors[missing], self.centroids, self.c_sq)
+            assign = dict(zip(missing, nearest.tolist()))
+        for i, key in enumerate(keys):
+            if key in self.where:
+                self.remove([key])
+            list_no = self._assignments.pop(key, None)
+            if list_no is None:
+                list_no = assign[i]
+            slot = self.lists[list_no].append(key, vectors[i], names[i])
+            self.where[key] = (list_no, slot)
+
+    def remove(self, keys):
+        for key in keys:
+            position = self.where.pop(key, None)
+            if position is None:
+                continue
+            list_no, slot = position
+            moved = self.lists[list_no].pop_slot(slot)
+            if moved is not None:
+                self.where[moved] = (list_no, slot)
+
+    def copy(self):
+        """An independent index with the same entries (array copies, no re-assignment)"""
+        index = IVFIndex(self.centroids, nprobe=self.nprobe, trained_size=self.trained_size)
+        for inv, source in zip(index.lists, self.lists):
+            size = len(source)
+            inv.vectors = source.vectors[:size].copy()
+            inv.sq_norms = source.sq_norms[:size].copy()
+            inv.keys = list(source.keys)
+            inv.names = list(source.names)
+        index.where = dict(self.where)
+        return index
+
+    def sync(self, keys, matrix, names):
+        """
+        Incrementally make the index hold exactly these rows: entries whose
+        key is gone, whose name changed or whose vector changed (an image
+        re-encoded in place) are removed, and those rows re-added to their
+        nearest list.
+        """
+        wanted = {key: i for i, key in enumerate(keys)}
+        stale = []
+        kept = {}   # list number -> [(slot, row, key)]
+        for key, (list_no, slot) in self.where.items():
+            row = wanted.get(key)
+            if row is None or self.lists[list_no].names[slot] != names[row]:
+                stale.append(key)
+            else:
+                kept.setdefault(list_no, []).append((slot, row, key))
+        for list_no, entries in kept.items():
+            slots = np.fromiter((slot for slot, _, _ in entries), dtype=np.intp, count=len(entries))
+            rows = np.fromiter((row for _, row, _ in entries), dtype=np.intp, count=len(entries))
+            changed = np.any(self.lists[list_no].vectors[slots] != as_encoding_matrix(matrix[rows]), axis=1)
+            for j in np.flatnonzero(changed):
+                stale.append(entries[j][2])
+                # A new vector may belong to another list
+                self._assignments.pop(entries[j][2], None)
+        self.remove(stale)
+        new = [i for key, i in wanted.items() if key not in self.where]
+        if new:
+            self.add([keys[i] for i in new], np.asarray(matrix)[new], [names[i] for i in new])
+        self._assignments = {}
+        return len(new), len(stale)
+
+    def match(self, face_encodings, confidence_threshold=0.6, nprobe=None):
+        """Same contract as FaceMatcher.match(), searching only the probed lists"""
+        if len(face_encodings) == 0:
+            return []
+        if len(self.where) == 0:
+            return [(None, float('inf'), 0.0) for _ in range(len(face_encodings))]
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        queries = as_encoding_matrix(face_encodings)
+        q_sq = np.einsum('ij,ij->i', queries, queries)
+        coarse = _sq_distances(queries, q_sq, self.centroids, self.c_sq)
+        # Never spend a probe on an empty list
+        coarse[:, [i for i, inv in enumerate(self.lists) if len(inv) == 0]] = np.inf
+        probes = np.argpartition(coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        results = []
+        for qi in range(len(queries)):
+            best_sq, best_name = np.inf, None
+            for list_no in probes[qi]:
+                inv = self.lists[list_no]
+                size = len(inv)
+                if size == 0:
+                    continue
+                sq = _sq_distances(queries[qi:qi + 1], q_sq[qi:qi + 1], inv.vectors[:size], inv.sq_norms[:size])[0]
+                j = int(np.argmin(sq))
+                if sq[j] < best_sq:
+                    best_sq, best_name = float(sq[j]), inv.names[j]
+            distance = float(np.sqrt(best_sq))
+            confidence = distance_to_confidence(distance)
+            results.append((best_name if confidence >= confidence_threshold else None, distance, confidence))
+        return results
+
+    def stats(self):
+        sizes = np.array([len(inv) for inv in self.lists])
+        return {
+            'entries': int(sizes.sum()),
+            'lists': len(self.lists),
+            'nprobe': self.nprobe,
+            'mean_list': round(float(sizes.mean()), 1) if len(sizes) else 0.0,
+            'max_list': int(sizes.max()) if len(sizes) else 0,
+            'trained_size': self.trained_size,
+        }
+
+    def save(self, path):
+        """Persist centroids and list assignments; vectors come from the gallery"""
+        keys = list(self.where)
+        list_nos = np.array([self.where[key][0] for key in keys], dtype=np.int32)
+        # Per-process name: two workers rebuilding at once must not share a temp file
+        tmp_path = f"{path}.tmp.{os.getpid()}.{secrets.token_hex(4)}"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, centroids=self.centroids, keys=np.array(keys, dtype=str),
+                         list_nos=list_nos, meta=np.array([self.nprobe, self.trained_size], dtype=np.int64))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, path, nprobe=None):
+        """Restore an index; call sync() with the gallery rows to fill the lists"""
+        with np.load(path, allow_pickle=False) as data:
+            saved_nprobe, trained_size = (int(v) for v in data['meta'])
+            index = cls(data['centroids'], nprobe=nprobe or saved_nprobe, trained_size=trained_size)
+            index._assignments = dict(zip(data['keys'].tolist(), data['list_nos'].tolist()))
+        return index
+
+
+def measure_recall(index, matcher, queries, nprobes=(1, 2, 4, 8, 16)):
+    """Recall@1 of the index against the exact matcher for several nprobe values"""
+    queries = as_encoding_matrix(queries)
+    started = time.perf_counter()
+    exact = matcher.match(queries, confidence_threshold=0.0)
+    exact_ms = (time.perf_counter() - started) * 1000.0 / max(len(queries), 1)
+    report = []
+    for nprobe in nprobes:
+        started = time.perf_counter()
+        approx = index.match(queries, confidence_threshold=0.0, nprobe=nprobe)
+        ann_ms = (time.perf_counter() - started) * 1000.0 / max(len(queries), 1)
+        same_name = sum(a[0] == e[0] for a, e in zip(approx, exact))
+        same_distance = sum(abs(a[1] - e[1]) < 1e-4 for a, e in zip(approx, exact))
+        report.append({
+            'nprobe': nprobe,
+            'recall': same_distance / max(len(queries), 1),
+            'name_agreement': same_name / max(len(queries), 1),
+            'ms_per_query': round(ann_ms, 3),
+            'exact_ms_per_query': round(exact_ms, 3),
+        })
+    return report
+
+
+def main():
+    from gallery_store import open_gallery
+
+    parser = argparse.ArgumentParser(description="Measure IVF and prototype matching against exact matching")
+    parser.add_argument("--gallery", default="gallery.bin")
+    parser.add_argument("--lists", type=int, default=None, help="number of inverted lists (default ~4*sqrt(N))")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, 3, 5],
+                        help="students re-scored by the two-stage prototype matcher")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.02, help="gaussian noise added to sampled rows")
+    args = parser.parse_args()
+
+    gallery = open_gallery(args.gallery)
+    keys = gallery.header.get('row_images') or [str(i) for i in range(len(gallery))]
+    print(f"🔧 Training IVF on {len(gallery)} encodings...")
+    started = time.time()
+    index = IVFIndex.train(gallery.encodings, n_lists=args.lists)
+    index.sync(keys, gallery.encodings, gallery.names)
+    print(f"✅ Built in {time.time() - started:.1f}s: {index.stats()}")
+
+    rng = np.random.default_rng(1)
+    rows = rng.choice(len(gallery), min(args.queries, len(gallery)), replace=False)
+    queries = np.asarray(gallery.encodings[np.sort(rows)]) + rng.normal(0, args.noise, (len(rows), ENCODING_DIM))
+    matcher = FaceMatcher(gallery.encodings, gallery.names)
+    for row in measure_recall(index, matcher, queries, args.nprobe):
+        print(f"   nprobe={row['nprobe']:>3}  recall@1={row['recall']:.3f}  "
+              f"name agreement={row['name_agreement']:.3f}  "
+              f"{row['ms_per_query']:.3f} ms/query (exact {row['exact_ms_per_query']:.3f})")
+
+    keys = list(keys)
+    for top_k in args.top_k:
+        prototypes = PrototypeMatcher(matcher, keys, top_k=top_k)
+        row = measure_agreement(prototypes, matcher, queries)
+        print(f"   prototypes top_k={top_k:>3}  decision agreement={row['decision_agreement']:.3f}  "
+              f"max distance delta={row['max_distance_delta']:.4f}  "
+              f"{row['ms_per_query']:.3f} ms/query (exact {row['exact_ms_per_query']:.3f})")
+
+
+if __name__ == "__main__":
+    main()
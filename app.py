@@ -2,16 +2,29 @@ from flask import Flask, render_template, request, redirect, url_for, session, f
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
-import cv2
-import face_recognition
-import numpy as np
 from datetime import datetime, timedelta
 import csv
 import base64
-import pickle
+import secrets
+import shlex
+import sys
 import threading
+import time
 from io import BytesIO
 import shutil
+from face_matcher import FaceMatcher, PrototypeMatcher
+from gallery_store import (
+    GalleryStoreError, open_gallery
+)
+from gallery_sync import remove_students, rename_student, stale_images, sync_gallery
+from dataset_watcher import DatasetWatcher
+from ann_index import IVFIndex
+from gallery_compact import compact_gallery
+from recognition_pool import InvalidImage, PoolBusy, RecognitionPool
+from detection import DEFAULT_STAGES, MAX_CLIENT_BOXES, CascadePlanner, parse_client_boxes
+from frame_gate import FrameGate, decode_thumbnail, route_stages
+from stream_session import StreamRegistry, TooManySessions
+from result_cache import ResultCache
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # Change this in production
@@ -100,272 +113,824 @@ class Attendance(db.Model):
     teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=False)
     student = db.relationship('Student', backref='attendance_records')
 
-# Load known face encodings with improved accuracy
-def load_known_faces():
-    dataset_path = "dataset"
-    known_encodings = []
-    known_names = []
-    student_encodings = {}  # Store multiple encodings per student
-    
-    for student_name in os.listdir(dataset_path):
-        student_folder = os.path.join(dataset_path, student_name)
-        
-        if not os.path.isdir(student_folder):
-            continue
-        
-        student_encodings[student_name] = []
-        
-        loaded_count = 0
-        skipped_count = 0
-        # Process all images for each student
-        for file in os.listdir(student_folder):
-            if file.endswith((".jpg", ".png")):
-                img_path = os.path.join(student_folder, file)
-                img = cv2.imread(img_path)
-                if img is None:
-                    continue
-                
-                # Resize large images for better processing
-                height, width = img.shape[:2]
-                if max(height, width) > 1280:
-                    scale = 1280 / max(height, width)
-                    new_width = int(width * scale)
-                    new_height = int(height * scale)
-                    img = cv2.resize(img, (new_width, new_height))
-                
-                rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-                # Try multiple face detection strategies
-                face_locations = face_recognition.face_locations(rgb_img, model="hog", number_of_times_to_upsample=1)
-                if len(face_locations) == 0:
-                    face_locations = face_recognition.face_locations(rgb_img, model="hog", number_of_times_to_upsample=2)
-                if len(face_locations) == 0:
-                    try:
-                        face_locations = face_recognition.face_locations(rgb_img, model="cnn", number_of_times_to_upsample=0)
-                    except Exception:
-                        face_locations = []
-
-                if len(face_locations) > 0:
-                    # If multiple faces, use the largest one
-                    if len(face_locations) > 1:
-                        def face_area(face_location):
-                            top, right, bottom, left = face_location
-                            return (bottom - top) * (right - left)
-                        face_locations = [max(face_locations, key=face_area)]
-                    
-                    encodings = face_recognition.face_encodings(rgb_img, face_locations)
-                    if len(encodings) > 0:
-                        student_encodings[student_name].append(encodings[0])
-                        loaded_count += 1
-                    else:
-                        skipped_count += 1
-                else:
-                    skipped_count += 1
-        print(f"ℹ️  Loaded encodings for {student_name}: {loaded_count} images, skipped {skipped_count}")
-    
-    # Add all encodings to the main lists
-    for student_name, encodings in student_encodings.items():
-        if encodings:  # Only add if we have at least one encoding
-            for encoding in encodings:
-                known_encodings.append(encoding)
-                known_names.append(student_name)
-    
-    print(f"✅ Loaded {len(set(known_names))} students with {len(known_encodings)} total encodings")
-    return known_encodings, known_names
+class GallerySnapshot:
+    """Immutable view of the gallery; requests read it without locking"""
+
+    def __init__(self, gallery, generation, dataset_mtime, class_of=None, matcher=None, index=None,
+                 prototypes=None):
+        self.gallery = gallery
+        self.names = gallery.names
+        self.matcher = matcher or FaceMatcher(gallery.encodings, gallery.names)
+        # Approximate index for school-wide search on large galleries (None = exact)
+        self.index = index
+        # Two-stage per-student prototype search for mid-sized galleries
+        self.prototypes = prototypes
+        self.generation = generation
+        self.dataset_mtime = dataset_mtime
+        self.class_of = class_of or {}   # student name -> class_name
+        self.loaded_at = datetime.now()
+        self._partitions = {}
+
+    def partition(self, class_name):
+        """Matcher limited to one class roster, built on first use"""
+        matcher = self._partitions.get(class_name)
+        if matcher is None:
+            rows = [i for i, name in enumerate(self.names) if self.class_of.get(name) == class_name]
+            matcher = self.matcher.subset(rows)
+            self._partitions[class_name] = matcher
+        return matcher
+
+    def partition_sizes(self):
+        return {class_name: len(matcher) for class_name, matcher in list(self._partitions.items())}
+
+    def with_classes(self, class_of, generation):
+        """Same gallery with a new roster mapping (after class changes)"""
+        return GallerySnapshot(self.gallery, generation, self.dataset_mtime, class_of, self.matcher, self.index,
+                               self.prototypes)
+
+    @property
+    def searcher(self):
+        """School-wide matcher: the ANN index, else the prototype matcher, else exact"""
+        if self.index is not None:
+            return self.index
+        return self.prototypes if self.prototypes is not None else self.matcher
+
+def _student_classes():
+    with app.app_context():
+        return {s.name: s.class_name for s in Student.query.all()}
 
-# Improved face recognition with confidence scoring
-def recognize_face_with_confidence(face_encoding, known_encodings, known_names, confidence_threshold=0.6):
+def _ann_index_for(gallery, previous=None):
     """
-    Recognize a face with confidence scoring
-    Returns (name, confidence) or (None, 0) if below threshold
+    IVF index for large galleries. A copy of the previous snapshot's index
+    is synced with the new rows, so only changed rows are touched; on the
+    first load the persisted centroids and list assignments are restored.
+    Retrains when the gallery has doubled since training. Returns None
+    below the size threshold.
     """
-    if len(known_encodings) == 0:
-        return None, 0
-    
-    # Calculate face distances
-    face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-    
-    # Find the best match
-    best_match_index = np.argmin(face_distances)
-    best_distance = face_distances[best_match_index]
-    
-    # Convert distance to confidence (0-1 scale, higher is better)
-    # face_recognition uses 0.6 as default threshold, so we'll use that as our baseline
-    confidence = max(0, 1 - (best_distance / 0.6))
-    
-    if confidence >= confidence_threshold:
-        return known_names[best_match_index], confidence
+    if len(gallery) < KNOWN_FACE_DATA['ann_min_rows']:
+        return None
+    path = KNOWN_FACE_DATA['gallery_path'] + '.ivf.npz'
+    index = None
+    if previous is not None and previous.index is not None:
+        # Copied: the previous snapshot keeps serving queries from its own index
+        index = previous.index.copy()
     else:
-        return None, confidence
+        try:
+            index = IVFIndex.load(path, nprobe=KNOWN_FACE_DATA['ann_nprobe'])
+        except Exception:
+            pass
+    if index is None or len(gallery) > 2 * index.trained_size:
+        started = time.time()
+        index = IVFIndex.train(gallery.encodings, nprobe=KNOWN_FACE_DATA['ann_nprobe'])
+        print(f"🔧 Trained IVF index with {len(index.lists)} lists in {time.time() - started:.1f}s")
+    keys = gallery.header.get('row_images') or [str(i) for i in range(len(gallery))]
+    added, removed = index.sync(keys, gallery.encodings, gallery.names)
+    try:
+        index.save(path)
+    except Exception as e:
+        print(f"⚠️  Could not save IVF index: {e}")
+    print(f"✅ IVF index ready ({len(index)} entries, +{added}/-{removed})")
+    return index
+
+def _prototypes_for(gallery, matcher, previous):
+    """
+    Per-student prototype matcher, updated from the previous snapshot's
+    centroids when there is one. None when disabled, when the IVF index is
+    in use, or when there are too few students for stage 1 to prune anything.
+    """
+    top_k = KNOWN_FACE_DATA['prototype_top_k']
+    if top_k <= 0 or len(gallery.labels) <= 2 * top_k:
+        return None
+    keys = gallery.header.get('row_images') or [str(i) for i in range(len(gallery))]
+    if previous is not None and previous.prototypes is not None and previous.prototypes.top_k == top_k:
+        return previous.prototypes.updated(matcher, keys)
+    return PrototypeMatcher(matcher, keys, top_k=top_k)
+
+def _new_snapshot(gallery, dataset_mtime):
+    KNOWN_FACE_DATA['generation'] += 1
+    matcher = FaceMatcher(gallery.encodings, gallery.names)
+    index = _ann_index_for(gallery, KNOWN_FACE_DATA['snapshot'])
+    prototypes = None
+    if index is None:
+        prototypes = _prototypes_for(gallery, matcher, KNOWN_FACE_DATA['snapshot'])
+    return GallerySnapshot(gallery, KNOWN_FACE_DATA['generation'], dataset_mtime, _student_classes(),
+                           matcher=matcher, index=index, prototypes=prototypes)
 
 # Cache known faces to avoid re-loading on every request
 KNOWN_FACE_DATA = {
-    'encodings': [],
-    'names': [],
-    'dataset_mtime': 0.0,
-    'encodings_pkl': 'encodings.pkl',
-    'is_loading': False
+    'snapshot': None,
+    'generation': 0,
+    'gallery_path': 'gallery.bin',
+    'ann_min_rows': int(os.environ.get('ANN_MIN_ROWS', '20000')),   # galleries this large use the IVF index
+    'ann_nprobe': int(os.environ.get('ANN_NPROBE', '8')),           # lists probed per face: recall vs latency
+    'prototype_top_k': int(os.environ.get('PROTOTYPE_TOP_K', '5')), # students re-scored after the centroid pass (0 = off)
+    # Auto-compaction of near-duplicate encodings after each sync (both 0 = off)
+    'compact_epsilon': float(os.environ.get('COMPACT_EPSILON', '0')),
+    'compact_max_per_student': int(os.environ.get('COMPACT_MAX_PER_STUDENT', '0')),
+    'is_loading': False,
+    'last_reload_seconds': 0.0,
+    'last_error': None
 }
-_LOAD_LOCK = threading.Lock()
-
-def get_dataset_mtime(path="dataset"):
+_LOAD_LOCK = threading.Lock()    # guards starting a background reload
+_BUILD_LOCK = threading.Lock()   # serializes gallery rebuilds
+
+# Per-request recognition DEBUG lines (faces, matches, bursts, streams) are
+# printed only with RECOGNITION_DEBUG=1; they sit on the hot path
+RECOGNITION_DEBUG = os.environ.get('RECOGNITION_DEBUG', '0') == '1'
+
+def debug_print(message):
+    if RECOGNITION_DEBUG:
+        print(f"DEBUG: {message}")
+
+# Frames accepted by /api/recognize_burst in one request, and how many the
+# Take Attendance page captures per click
+BURST_MAX_FRAMES = int(os.environ.get('BURST_MAX_FRAMES', '8'))
+BURST_FRAMES = max(1, min(int(os.environ.get('BURST_FRAMES', '4')), BURST_MAX_FRAMES))
+
+# Detection/encoding worker processes, so the web tier can run threaded
+RECOGNITION_POOL = RecognitionPool(
+    workers=int(os.environ.get('RECOGNITION_WORKERS', '2')),   # 0 = run inline, serialized
+    max_queue=int(os.environ.get('RECOGNITION_QUEUE', '0')) or None,
+    # Frames from concurrent requests are encoded together in micro-batches
+    max_batch=int(os.environ.get('RECOGNITION_BATCH', '8')),
+    max_wait_ms=float(os.environ.get('RECOGNITION_BATCH_WAIT_MS', '5'))
+)
+
+# Detection cascade: stage order/enable flags, per-frame time budget and
+# per-classroom learning of which stages are worth running
+CASCADE_PLANNER = CascadePlanner(
+    stages=[name.strip() for name in os.environ.get('DETECT_STAGES', ','.join(DEFAULT_STAGES)).split(',')
+            if name.strip()],
+    budget_ms=float(os.environ.get('DETECT_BUDGET_MS', '800')) or None,   # 0 = no budget
+    adaptive=os.environ.get('DETECT_ADAPTIVE', '1') == '1'
+)
+
+# Pre-filter scored on a thumbnail: dark frames go straight to CLAHE, sharp
+# well-lit ones skip it, and bursts drop blurred and duplicate frames
+FRAME_GATE = FrameGate(
+    blur_threshold=float(os.environ.get('GATE_BLUR_THRESHOLD', '40')),
+    dark_threshold=float(os.environ.get('GATE_DARK_THRESHOLD', '60'))
+) if os.environ.get('FRAME_GATE', '1') == '1' else None
+
+# Repeated captures of an almost identical scene reuse the previous result
+RESULT_CACHE = ResultCache(
+    max_entries=int(os.environ.get('RESULT_CACHE_ENTRIES', '8')),       # per browser session
+    max_distance=int(os.environ.get('RESULT_CACHE_HAMMING', '4')),      # dHash bits out of 64
+    ttl_seconds=float(os.environ.get('RESULT_CACHE_TTL', '60'))
+) if os.environ.get('RESULT_CACHE', '1') == '1' else None
+
+# Live attendance sessions: frames POSTed at STREAM_MAX_FPS, results over SSE
+STREAM_SESSIONS = StreamRegistry(max_sessions=int(os.environ.get('STREAM_MAX_SESSIONS', '8')))
+STREAM_MAX_FPS = float(os.environ.get('STREAM_MAX_FPS', '4'))
+# Sessions live in this process's memory, so their frame/event requests must
+# reach the same process: refuse them when several web workers share the port.
+
+
+def _web_worker_count():
+    """
+    Worker processes serving this app: WEB_CONCURRENCY (gunicorn's default),
+    overridden by -w/--workers on the gunicorn command line or in
+    GUNICORN_CMD_ARGS. A workers setting in a gunicorn config file is not seen.
+    """
+    workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+    if 'gunicorn' not in os.path.basename(sys.argv[0]):
+        return workers
+    args = shlex.split(os.environ.get('GUNICORN_CMD_ARGS', '')) + sys.argv[1:]
+    for i, arg in enumerate(args):
+        value = None
+        if arg in ('-w', '--workers') and i + 1 < len(args):
+            value = args[i + 1]
+        elif arg.startswith('--workers='):
+            value = arg.split('=', 1)[1]
+        elif arg.startswith('-w') and arg[2:].isdigit():
+            value = arg[2:]
+        if value is not None and value.isdigit():
+            workers = int(value)
+    return workers
+
+
+WEB_WORKERS = _web_worker_count()
+
+# Scans dataset/ in the background so requests only read a cached fingerprint
+DATASET_WATCHER = DatasetWatcher('dataset', ttl=2.0)
+# Removed students' folders wait here until the database commit succeeded
+REMOVED_DATASET_DIR = '.dataset_removed'
+
+def _rebuild_snapshot():
+    """Bring the gallery up to date and atomically swap in a new snapshot"""
+    with _BUILD_LOCK:
+        listing = DATASET_WATCHER.listing
+        current_mtime = DATASET_WATCHER.mtime
+        snapshot = KNOWN_FACE_DATA['snapshot']
+        if snapshot is not None and snapshot.dataset_mtime >= current_mtime:
+            return snapshot
+
+        started = time.time()
+        gallery_path = KNOWN_FACE_DATA['gallery_path']
+        gallery = snapshot.gallery if snapshot is not None else None
+        if gallery is None:
+            try:
+                gallery = open_gallery(gallery_path)
+            except GalleryStoreError as e:
+                print(f"ℹ️  No usable gallery yet: {e}")
+
+        # Fresh only if the manifest matches the dataset file by file; an mtime
+        # check misses deletions and files restored with old timestamps after a
+        # restart. dataset_mtime 0 marks a checkpoint of an interrupted sync.
+        if gallery is not None and gallery.dataset_mtime > 0 and stale_images(gallery, listing) == ([], []):
+            print(f"✅ Mapped gallery {gallery_path} ({len(gallery.labels)} students, {len(gallery)} encodings)")
+        else:
+            # Encode only new/changed images and merge into the existing gallery
+            # New images are encoded on the recognition workers, not in this web process
+            gallery = sync_gallery(gallery_path, previous=gallery, dataset_mtime=current_mtime, current=listing,
+                                   encoder=RECOGNITION_POOL.encode_images)
+            if KNOWN_FACE_DATA['compact_epsilon'] > 0 or KNOWN_FACE_DATA['compact_max_per_student'] > 0:
+                gallery = compact_gallery(gallery_path, gallery, KNOWN_FACE_DATA['compact_epsilon'],
+                                          KNOWN_FACE_DATA['compact_max_per_student'])
+
+        snapshot = _new_snapshot(gallery, current_mtime)
+        KNOWN_FACE_DATA['snapshot'] = snapshot
+        KNOWN_FACE_DATA['last_reload_seconds'] = time.time() - started
+        KNOWN_FACE_DATA['last_error'] = None
+        return snapshot
+
+def _background_reload():
     try:
-        latest = os.path.getmtime(path)
-        for root, dirs, files in os.walk(path):
-            for name in files:
-                try:
-                    latest = max(latest, os.path.getmtime(os.path.join(root, name)))
-                except Exception:
-                    pass
-        return latest
-    except Exception:
-        return 0.0
-
-def ensure_known_faces_loaded():
-    current_mtime = get_dataset_mtime()
-    need_reload = (
-        not KNOWN_FACE_DATA['encodings'] or not KNOWN_FACE_DATA['names'] or
-        current_mtime > KNOWN_FACE_DATA['dataset_mtime']
-    )
-
-    if not need_reload:
-        return KNOWN_FACE_DATA['encodings'], KNOWN_FACE_DATA['names']
+        _rebuild_snapshot()
+    except Exception as e:
+        KNOWN_FACE_DATA['last_error'] = str(e)
+        print(f"⚠️  Background gallery reload failed: {e}")
+    finally:
+        KNOWN_FACE_DATA['is_loading'] = False
 
-    with _LOAD_LOCK:
-        # Re-check inside lock
-        current_mtime = get_dataset_mtime()
-        need_reload = (
-            not KNOWN_FACE_DATA['encodings'] or not KNOWN_FACE_DATA['names'] or
-            current_mtime > KNOWN_FACE_DATA['dataset_mtime']
-        )
-        if not need_reload:
-            return KNOWN_FACE_DATA['encodings'], KNOWN_FACE_DATA['names']
+def _edit_gallery(fs_change, gallery_change):
+    """
+    Apply a dataset/ change the app makes itself (remove/rename a student)
+    and edit the gallery rows in place, so no re-encode or rebuild follows.
+    """
+    with _BUILD_LOCK:
+        DATASET_WATCHER.scan_now()
+        snapshot = KNOWN_FACE_DATA['snapshot']
+        was_fresh = snapshot is not None and snapshot.dataset_mtime >= DATASET_WATCHER.mtime
+        fs_change()
+        current_mtime = DATASET_WATCHER.scan_now()
+        if snapshot is None:
+            # Nothing loaded yet; the first load will sync from disk
+            return
+        # Only claim the new fingerprint if nothing else was pending
+        dataset_mtime = current_mtime if was_fresh else snapshot.dataset_mtime
+        gallery = gallery_change(KNOWN_FACE_DATA['gallery_path'], snapshot.gallery, dataset_mtime)
+        KNOWN_FACE_DATA['snapshot'] = _new_snapshot(gallery, dataset_mtime)
+
+def _refresh_class_partitions():
+    """Swap in a snapshot with the current roster mapping; no gallery I/O"""
+    with _BUILD_LOCK:
+        snapshot = KNOWN_FACE_DATA['snapshot']
+        if snapshot is None:
+            return
+        KNOWN_FACE_DATA['generation'] += 1
+        KNOWN_FACE_DATA['snapshot'] = snapshot.with_classes(_student_classes(), KNOWN_FACE_DATA['generation'])
 
+def ensure_known_faces_loaded():
+    """
+    Return the current GallerySnapshot. A stale snapshot keeps being served
+    while a background thread rebuilds; only the very first load blocks.
+    """
+    current_mtime = DATASET_WATCHER.start().mtime
+    snapshot = KNOWN_FACE_DATA['snapshot']
+    if snapshot is None:
         KNOWN_FACE_DATA['is_loading'] = True
         try:
-            # Try loading from pickle if fresh
-            pkl_path = KNOWN_FACE_DATA['encodings_pkl']
-            try:
-                pkl_mtime = os.path.getmtime(pkl_path)
-            except Exception:
-                pkl_mtime = 0.0
-
-            if pkl_mtime >= current_mtime and os.path.exists(pkl_path):
-                with open(pkl_path, 'rb') as f:
-                    data = pickle.load(f)
-                encs = data.get('encodings', [])
-                names = data.get('names', [])
-                print(f"✅ Loaded encodings from {pkl_path} ({len(set(names))} students, {len(encs)} encodings)")
-            else:
-                encs, names = load_known_faces()
-                # Save to pickle for future fast starts
-                try:
-                    with open(pkl_path, 'wb') as f:
-                        pickle.dump({'encodings': encs, 'names': names}, f)
-                    print(f"💾 Saved encodings to {pkl_path}")
-                except Exception as e:
-                    print(f"⚠️  Could not save encodings to pickle: {e}")
-
-            KNOWN_FACE_DATA['encodings'] = encs
-            KNOWN_FACE_DATA['names'] = names
-            KNOWN_FACE_DATA['dataset_mtime'] = current_mtime
+            return _rebuild_snapshot()
         finally:
             KNOWN_FACE_DATA['is_loading'] = False
 
-    return KNOWN_FACE_DATA['encodings'], KNOWN_FACE_DATA['names']
+    if current_mtime > snapshot.dataset_mtime and not KNOWN_FACE_DATA['is_loading']:
+        with _LOAD_LOCK:
+            if not KNOWN_FACE_DATA['is_loading']:
+                KNOWN_FACE_DATA['is_loading'] = True
+                threading.Thread(target=_background_reload, name='gallery-reload', daemon=True).start()
+    return snapshot
 
-@app.route('/api/recognize', methods=['POST'])
-def api_recognize():
+@app.route('/api/gallery_status')
+def api_gallery_status():
     if not validate_session():
         return jsonify({'error': 'Not authenticated'}), 401
-    try:
+    snapshot = KNOWN_FACE_DATA['snapshot']
+    return jsonify({
+        'generation': snapshot.generation if snapshot else 0,
+        'students': len(set(snapshot.names)) if snapshot else 0,
+        'encodings': len(snapshot.names) if snapshot else 0,
+        'dataset_mtime': snapshot.dataset_mtime if snapshot else 0.0,
+        'loaded_at': snapshot.loaded_at.isoformat() if snapshot else None,
+        'stale': bool(snapshot) and DATASET_WATCHER.mtime > snapshot.dataset_mtime,
+        'is_loading': KNOWN_FACE_DATA['is_loading'],
+        'last_reload_seconds': round(KNOWN_FACE_DATA['last_reload_seconds'], 3),
+        'last_error': KNOWN_FACE_DATA['last_error'],
+        'partitions': snapshot.partition_sizes() if snapshot else {},
+        'ann': snapshot.index.stats() if snapshot and snapshot.index is not None else None,
+        'prototypes': snapshot.prototypes.stats() if snapshot and snapshot.prototypes is not None else None,
+        'watcher': DATASET_WATCHER.stats()
+    })
+
+def recognition_scope(params):
+    """
+    Resolve which roster to search: an explicit class_name (remembered in the
+    session), else the session's last class, else the whole school.
+    'all' / empty forces a school-wide search. Raises ValueError for a
+    class_name that is not a string (e.g. a number in a JSON body).
+    """
+    class_name = params.get('class_name')
+    if class_name is None:
+        class_name = session.get('attendance_class')
+    elif not isinstance(class_name, str):
+        raise ValueError("class_name must be a string")
+    else:
+        class_name = class_name.strip()
+        session['attendance_class'] = class_name
+    if class_name in ('', 'all'):
+        class_name = None
+    fallback = str(params.get('fallback', '')).lower() in ('1', 'true', 'yes')
+    return class_name, fallback
+
+def read_request_image():
+    """
+    Read the uploaded frame of a recognition request. Accepts a raw
+    image/jpeg (or image/png) body with options in the query string, a
+    multipart upload in the `image` field, or the legacy JSON body with a
+    base64 data URL. Returns (encoded image bytes, params, error); the
+    bytes are decoded by the recognition worker.
+    """
+    content_type = request.mimetype or ''
+    if content_type.startswith('image/'):
+        # Raw body: passed on as-is, no base64/JSON
+        buffer = request.get_data(cache=False)
+        params = request.args
+    elif content_type == 'multipart/form-data':
+        upload = request.files.get('image')
+        if upload is None:
+            return None, None, 'No image provided'
+        buffer = upload.read()
+        params = request.form if request.form else request.args
+    else:
         data = request.get_json(silent=True) or {}
         image_data_url = data.get('image')
         if not image_data_url or not isinstance(image_data_url, str):
-            return jsonify({'error': 'No image provided'}), 400
-
-        # Strip data URL header if present
-        if ',' in image_data_url:
-            image_b64 = image_data_url.split(',', 1)[1]
+            return None, None, 'No image provided'
+        buffer = _data_url_bytes(image_data_url)
+        params = data
+    if not buffer:
+        return None, None, 'No image provided'
+    return buffer, params, None
+
+def _data_url_bytes(image_data_url):
+    # Strip data URL header if present
+    image_b64 = image_data_url.split(',', 1)[1] if ',' in image_data_url else image_data_url
+    return base64.b64decode(image_b64)
+
+def read_request_frames(max_frames):
+    """
+    Read the frames of a burst request: a multipart upload with repeated
+    `frames` fields, or JSON {"images": [data URL, ...]}. Returns
+    (list of encoded image bytes, params, error).
+    """
+    if (request.mimetype or '') == 'multipart/form-data':
+        buffers = [upload.read() for upload in request.files.getlist('frames')]
+        params = request.form if request.form else request.args
+    else:
+        data = request.get_json(silent=True) or {}
+        images = data.get('images')
+        if not isinstance(images, list):
+            return None, None, 'No frames provided'
+        buffers = [_data_url_bytes(image) for image in images if isinstance(image, str)]
+        params = data
+    buffers = [buffer for buffer in buffers if buffer]
+    if not buffers:
+        return None, None, 'No frames provided'
+    if len(buffers) > max_frames:
+        return None, None, f'At most {max_frames} frames per burst'
+    return buffers, params, None
+
+def read_burst_boxes(params, frames):
+    """
+    Optional client face boxes per burst frame: repeated multipart `boxes`
+    fields or a JSON list, one entry per frame (empty/null: the server
+    detects that frame). Returns a list of box lists or None per frame.
+    Raises ValueError.
+    """
+    if hasattr(params, 'getlist'):
+        values = params.getlist('boxes')
+    else:
+        values = params.get('boxes') or []
+        if not isinstance(values, list):
+            raise ValueError("boxes must be a list with one entry per frame")
+    if not values:
+        return [None] * frames
+    if len(values) != frames:
+        raise ValueError(f"Got boxes for {len(values)} of {frames} frames")
+    return [parse_client_boxes(value) if value not in (None, '') else None for value in values]
+
+def match_faces(snapshot, face_encodings, class_name=None, fallback=False, confidence_threshold=0.50):
+    """
+    Match all faces of a frame in one batched call against the class
+    partition (or the whole gallery). With fallback, faces unknown in the
+    class are retried school-wide. Yields (name, distance, confidence, scope).
+    """
+    if not class_name:
+        for name, distance, confidence in snapshot.searcher.match(face_encodings, confidence_threshold):
+            yield name, distance, confidence, 'school'
+        return
+
+    results = snapshot.partition(class_name).match(face_encodings, confidence_threshold)
+    retry = [i for i, (name, _, _) in enumerate(results) if name is None] if fallback else []
+    school = dict(zip(retry, snapshot.searcher.match([face_encodings[i] for i in retry], confidence_threshold)))
+    for i, (name, distance, confidence) in enumerate(results):
+        if i in school and school[i][0] is not None:
+            yield school[i] + ('school',)
         else:
-            image_b64 = image_data_url
-
-        image_bytes = base64.b64decode(image_b64)
-        np_arr = np.frombuffer(image_bytes, np.uint8)
-        frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        if frame is None:
-            return jsonify({'error': 'Invalid image data'}), 400
-        h, w = frame.shape[:2]
-        print(f"DEBUG: Decoded frame {w}x{h}")
-
-        # If the frame is very small, upscale before detection
-        if max(h, w) < 400:
-            scale = 400.0 / max(h, w)
-            new_w = int(w * scale)
-            new_h = int(h * scale)
-            frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
-            print(f"DEBUG: Upscaled frame to {new_w}x{new_h}")
-
-        # Lean fast-path detection: assume client already downscaled
-        rgb_small = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        face_locations = face_recognition.face_locations(rgb_small, number_of_times_to_upsample=1, model="hog")
-        if not face_locations:
-            # One extra upsample pass as fallback
-            face_locations = face_recognition.face_locations(rgb_small, number_of_times_to_upsample=2, model="hog")
-        if not face_locations:
-            # Last resort: try at slightly larger scale
-            try:
-                bigger = cv2.resize(rgb_small, (0, 0), fx=1.25, fy=1.25)
-                face_locations = face_recognition.face_locations(bigger, number_of_times_to_upsample=2, model="hog")
-                if face_locations:
-                    rgb_small = bigger
-            except Exception:
-                pass
-
-        # If still nothing, try light enhancement (CLAHE on Y channel)
-        if not face_locations:
-            try:
-                yuv = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV)
-                y, u, v = cv2.split(yuv)
-                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-                y_eq = clahe.apply(y)
-                yuv_eq = cv2.merge((y_eq, u, v))
-                bgr_eq = cv2.cvtColor(yuv_eq, cv2.COLOR_YUV2BGR)
-                rgb_eq = cv2.cvtColor(bgr_eq, cv2.COLOR_BGR2RGB)
-                face_locations = face_recognition.face_locations(rgb_eq, number_of_times_to_upsample=2, model="hog")
-                if face_locations:
-                    rgb_small = rgb_eq
-            except Exception:
-                pass
+            yield name, distance, confidence, 'class'
 
-        face_encodings = face_recognition.face_encodings(rgb_small, face_locations)
+@app.route('/api/recognition_status')
+def api_recognition_status():
+    if not validate_session():
+        return jsonify({'error': 'Not authenticated'}), 401
+    return jsonify({'pool': RECOGNITION_POOL.stats(), 'cascade': CASCADE_PLANNER.stats(),
+                    'gate': FRAME_GATE.stats() if FRAME_GATE is not None else None,
+                    'streams': STREAM_SESSIONS.stats(),
+                    'result_cache': RESULT_CACHE.stats() if RESULT_CACHE is not None else None})
 
-        known_encodings, known_names = ensure_known_faces_loaded()
+@app.route('/api/recognize', methods=['POST'])
+def api_recognize():
+    if not validate_session():
+        return jsonify({'error': 'Not authenticated'}), 401
+    try:
+        buffer, params, error = read_request_image()
+        if error:
+            return jsonify({'error': error}), 400
+        try:
+            class_name, fallback = recognition_scope(params)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        request_started = time.perf_counter()
+        snapshot = ensure_known_faces_loaded()
+
+        thumbnail = None
+        if FRAME_GATE is not None or RESULT_CACHE is not None:
+            thumbnail = decode_thumbnail(buffer)
+            if thumbnail is None:
+                return jsonify({'error': 'Invalid image data'}), 400
+
+        cache_key = cache_scope = None
+        if RESULT_CACHE is not None:
+            # Per browser session and search scope; entries die with the snapshot generation
+            cache_scope = (session.setdefault('recognize_cache_id', secrets.token_hex(8)), class_name, fallback)
+            cache_key = RESULT_CACHE.key(thumbnail)
+            cached = RESULT_CACHE.lookup(cache_scope, cache_key, snapshot.generation)
+            if cached is not None:
+                debug_print(f"/api/recognize served from cache ({len(cached['detections'])} detections)")
+                return jsonify(dict(cached, cached=True))
+
+        plan = CASCADE_PLANNER.plan(class_name)
+        quality = None
+        if FRAME_GATE is not None:
+            decision, quality, _ = FRAME_GATE.assess(thumbnail)
+            plan['stages'] = route_stages(plan['stages'], decision)
+
+        # Detection and encoding run in a worker process; this thread only waits
+        started = time.perf_counter()
+        face_locations, face_encodings, report = RECOGNITION_POOL.recognize(buffer, plan)
+        CASCADE_PLANNER.record(class_name, report)
+        if FRAME_GATE is not None:
+            FRAME_GATE.record((time.perf_counter() - started) * 1000.0)
 
         detections = []
-        print(f"DEBUG: /api/recognize faces={len(face_locations)}")
-        for face_encoding, face_location in zip(face_encodings, face_locations):
-            name, confidence = recognize_face_with_confidence(
-                face_encoding,
-                known_encodings,
-                known_names,
-                confidence_threshold=0.50
-            )
+        debug_print(f"/api/recognize faces={len(face_locations)}")
+        for name, distance, confidence, scope in match_faces(snapshot, face_encodings, class_name, fallback):
             if name is None:
                 name = 'Unknown'
-                confidence = float(confidence)
             else:
                 # Log best match for debugging
-                print(f"DEBUG: matched name={name} conf={confidence:.2f}")
+                debug_print(f"matched name={name} conf={confidence:.2f} dist={distance:.3f} scope={scope}")
             detections.append({
                 'name': name,
-                'confidence': float(confidence)
+                'confidence': float(confidence),
+                'scope': scope
             })
 
-        return jsonify({'success': True, 'detections': detections})
+        result = {
+            'success': True,
+            'detections': detections,
+            'class_name': class_name,
+            # Stage that found the faces; partial when the time budget cut the cascade short
+            'detection': {'stage': report['stage'], 'partial': report['budget_exhausted'],
+                          'elapsed_ms': report['elapsed_ms'],
+                          # 'dark', 'blurred' or 'ok': lets the page suggest a retake
+                          'quality': quality}
+        }
+        if RESULT_CACHE is not None:
+            RESULT_CACHE.store(cache_scope, cache_key, snapshot.generation, result,
+                               (time.perf_counter() - request_started) * 1000.0)
+        return jsonify(dict(result, cached=False))
+    except InvalidImage as e:
+        return jsonify({'error': str(e)}), 400
+    except PoolBusy as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/recognize_faces', methods=['POST'])
+def api_recognize_faces():
+    """
+    Recognize faces the client already located: a frame (any /api/recognize
+    format) plus `boxes`, or multipart `chips` of cropped faces. The boxes
+    are only sanity-checked, so server-side detection is skipped entirely.
+    """
+    if not validate_session():
+        return jsonify({'error': 'Not authenticated'}), 401
+    try:
+        chips = request.files.getlist('chips') if (request.mimetype or '') == 'multipart/form-data' else []
+        if chips:
+            if len(chips) > MAX_CLIENT_BOXES:
+                return jsonify({'error': f'At most {MAX_CLIENT_BOXES} chips per request'}), 400
+            params = request.form if request.form else request.args
+            items = [(chip.read(), {'chip': True}) for chip in chips]
+        else:
+            buffer, params, error = read_request_image()
+            if error:
+                return jsonify({'error': error}), 400
+            try:
+                boxes = parse_client_boxes(params.get('boxes'))
+            except (ValueError, KeyError, TypeError) as e:
+                return jsonify({'error': f'Invalid boxes: {e}'}), 400
+            items = [(buffer, {'boxes': boxes})]
+        try:
+            class_name, fallback = recognition_scope(params)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        jobs = [RECOGNITION_POOL.submit(buffer, plan) for buffer, plan in items]
+        face_locations, face_encodings = [], []
+        verify_ms, rejected = 0.0, 0
+        for job in jobs:
+            locations, encodings, report = job.result(30.0)
+            face_locations.extend(locations)
+            face_encodings.extend(encodings)
+            verify_ms += report['elapsed_ms']
+            rejected += report['rejected_boxes']
+        saved_ms = CASCADE_PLANNER.record_skipped(class_name, verify_ms)
+        if saved_ms is not None:
+            debug_print(f"/api/recognize_faces skipped detection, saved ~{saved_ms:.0f} ms")
+
+        snapshot = ensure_known_faces_loaded()
+        detections = []
+        matches = match_faces(snapshot, face_encodings, class_name, fallback)
+        for location, (name, distance, confidence, scope) in zip(face_locations, matches):
+            detections.append({
+                'name': name or 'Unknown',
+                'confidence': float(confidence),
+                'scope': scope,
+                'box': list(location) if not chips else None
+            })
+
+        return jsonify({
+            'success': True,
+            'detections': detections,
+            'class_name': class_name,
+            'detection': {'stage': 'client', 'rejected_boxes': rejected,
+                          'saved_ms': round(saved_ms, 1) if saved_ms is not None else None}
+        })
+    except InvalidImage as e:
+        return jsonify({'error': str(e)}), 400
+    except PoolBusy as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def aggregate_burst(frame_matches, frame_count, mode='vote', min_votes=1):
+    """
+    Consolidate per-frame matches into one detection per student.
+    frame_matches holds (frame index, name, confidence, scope) per face. A
+    student gets one vote per frame they were matched in; 'vote' ranks by
+    votes then mean confidence, 'max' by the best single-frame confidence.
+    """
+    best = {}   # (name, frame) -> (confidence, scope), best face per frame
+    for frame_no, name, confidence, scope in frame_matches:
+        if name is None:
+            continue
+        key = (name, frame_no)
+        if key not in best or confidence > best[key][0]:
+            best[key] = (confidence, scope)
+
+    per_name = {}
+    for (name, frame_no), (confidence, scope) in best.items():
+        per_name.setdefault(name, []).append((confidence, scope))
+
+    detections = []
+    for name, hits in per_name.items():
+        if len(hits) < min_votes:
+            continue
+        confidences = [confidence for confidence, _ in hits]
+        top_confidence, top_scope = max(hits, key=lambda hit: hit[0])
+        detections.append({
+            'name': name,
+            'confidence': float(top_confidence if mode == 'max' else sum(confidences) / len(confidences)),
+            'max_confidence': float(top_confidence),
+            'votes': len(hits),
+            'frames': frame_count,
+            'scope': top_scope
+        })
+    if mode == 'max':
+        detections.sort(key=lambda d: -d['max_confidence'])
+    else:
+        detections.sort(key=lambda d: (-d['votes'], -d['confidence']))
+    return detections
+
+@app.route('/api/recognize_burst', methods=['POST'])
+def api_recognize_burst():
+    """
+    Recognize a burst of frames in one round trip. Faces of all frames are
+    matched in one batched gallery call and aggregated per student, so a
+    blink or head turn in one frame does not lose the student. Frames the
+    client already found faces in (see read_burst_boxes) skip detection.
+    """
+    if not validate_session():
+        return jsonify({'error': 'Not authenticated'}), 401
+    try:
+        buffers, params, error = read_request_frames(BURST_MAX_FRAMES)
+        if error:
+            return jsonify({'error': error}), 400
+        try:
+            class_name, fallback = recognition_scope(params)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        mode = params.get('aggregate', 'vote')
+        if mode not in ('vote', 'max'):
+            return jsonify({'error': "aggregate must be 'vote' or 'max'"}), 400
+        try:
+            min_votes = max(1, int(params.get('min_votes', 1)))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'min_votes must be an integer'}), 400
+        try:
+            frame_boxes = read_burst_boxes(params, len(buffers))
+        except (ValueError, KeyError, TypeError) as e:
+            return jsonify({'error': f'Invalid boxes: {e}'}), 400
+
+        started = time.time()
+        if FRAME_GATE is not None:
+            thumbnails = [decode_thumbnail(buffer) for buffer in buffers]
+            if any(thumbnail is None for thumbnail in thumbnails):
+                return jsonify({'error': 'Invalid image data'}), 400
+            gated = FRAME_GATE.burst(thumbnails)
+        else:
+            gated = [('process', None, None)] * len(buffers)
+
+        face_frames = []
+        face_encodings = []
+        faces_per_frame = [None] * len(buffers)   # None: frame dropped by the gate
+        # All frames are queued at once so idle workers process them in parallel
+        jobs = {}
+        for frame_no, (buffer, (decision, _, _)) in enumerate(zip(buffers, gated)):
+            if decision not in ('process', 'enhance'):
+                continue
+            if frame_boxes[frame_no] is not None:
+                plan = {'boxes': frame_boxes[frame_no]}
+            else:
+                plan = CASCADE_PLANNER.plan(class_name)
+                if FRAME_GATE is not None:
+                    plan['stages'] = route_stages(plan['stages'], decision)
+            jobs[frame_no] = RECOGNITION_POOL.submit(buffer, plan)
+        partial_frames = 0
+        for frame_no, job in jobs.items():
+            face_locations, encodings, report = job.result(30.0)
+            if frame_boxes[frame_no] is not None:
+                CASCADE_PLANNER.record_skipped(class_name, report['elapsed_ms'])
+            else:
+                CASCADE_PLANNER.record(class_name, report)
+            partial_frames += report['budget_exhausted']
+            faces_per_frame[frame_no] = len(face_locations)
+            face_frames.extend([frame_no] * len(encodings))
+            face_encodings.extend(encodings)
+        if FRAME_GATE is not None:
+            # Frames ran in parallel: charge each an equal share of the wall time
+            for _ in jobs:
+                FRAME_GATE.record((time.time() - started) * 1000.0 / len(jobs))
+
+        snapshot = ensure_known_faces_loaded()
+        frame_matches = [
+            (frame_no, name, confidence, scope)
+            for frame_no, (name, distance, confidence, scope)
+            in zip(face_frames, match_faces(snapshot, face_encodings, class_name, fallback))
+        ]
+        # A skipped near-duplicate votes like the frame it duplicates
+        for frame_no, (decision, _, duplicate_of) in enumerate(gated):
+            if decision == 'skip':
+                faces_per_frame[frame_no] = faces_per_frame[duplicate_of]
+                frame_matches.extend((frame_no, name, confidence, scope)
+                                     for source, name, confidence, scope in list(frame_matches)
+                                     if source == duplicate_of)
+        voting_frames = sum(decision != 'defer' for decision, _, _ in gated)
+        detections = aggregate_burst(frame_matches, voting_frames, mode, min_votes)
+        unknown_per_frame = [0] * len(buffers)
+        for frame_no, name, _, _ in frame_matches:
+            if name is None:
+                unknown_per_frame[frame_no] += 1
+        debug_print(f"/api/recognize_burst frames={len(buffers)} processed={len(jobs)} faces={faces_per_frame} "
+                    f"students={len(detections)} in {time.time() - started:.2f}s")
+
+        return jsonify({
+            'success': True,
+            'detections': detections,
+            'class_name': class_name,
+            'frames': len(buffers),
+            'faces_per_frame': faces_per_frame,
+            # Most unrecognized faces seen together in one frame
+            'unknown_faces': max(unknown_per_frame),
+            # Frames whose detection cascade was cut short by the time budget
+            'partial_frames': partial_frames,
+            # Frames the quality gate dropped as blurred / as duplicates of another frame
+            'deferred_frames': sum(decision == 'defer' for decision, _, _ in gated),
+            'skipped_frames': sum(decision == 'skip' for decision, _, _ in gated),
+            'aggregate': mode
+        })
+    except InvalidImage as e:
+        return jsonify({'error': str(e)}), 400
+    except PoolBusy as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def _stream_matcher(class_name, fallback):
+    def match(face_encodings):
+        # The current snapshot per detection, so a gallery reload is picked up mid-session
+        snapshot = ensure_known_faces_loaded()
+        return [(name, distance, confidence)
+                for name, distance, confidence, _ in match_faces(snapshot, face_encodings, class_name, fallback)]
+    return match
+
+@app.route('/api/stream/start', methods=['POST'])
+def api_stream_start():
+    """
+    Open a live attendance session. The page then POSTs JPEG frames to
+    /api/stream/<id>/frame and listens to /api/stream/<id>/events.
+    """
+    if not validate_session():
+        return jsonify({'error': 'Not authenticated'}), 401
+    if WEB_WORKERS > 1:
+        return jsonify({'error': 'Live sessions need a single web worker process (gunicorn -w 1); '
+                                 'use Capture instead'}), 503
+    params = request.get_json(silent=True) or request.form
+    try:
+        class_name, fallback = recognition_scope(params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        stream = STREAM_SESSIONS.open(owner=session['teacher_id'], class_name=class_name, fallback=fallback,
+                                      pool=RECOGNITION_POOL, planner=CASCADE_PLANNER,
+                                      match=_stream_matcher(class_name, fallback), max_fps=STREAM_MAX_FPS)
+    except TooManySessions as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '5'}
+    debug_print(f"stream {stream.id[:6]} started class={class_name}")
+    return jsonify({'success': True, 'session_id': stream.id, 'max_fps': stream.max_fps,
+                    'class_name': class_name})
+
+@app.route('/api/stream/<session_id>/frame', methods=['POST'])
+def api_stream_frame(session_id):
+    """Hand one frame to a session; returns at once, never waits for recognition"""
+    if not validate_session():
+        return jsonify({'error': 'Not authenticated'}), 401
+    stream = STREAM_SESSIONS.get(session_id, session['teacher_id'])
+    if stream is None or stream.closed:
+        return jsonify({'error': 'No such streaming session'}), 404
+    buffer, _, error = read_request_image()
+    if error:
+        return jsonify({'error': error}), 400
+    stream.push(buffer)
+    return jsonify({'accepted': True, 'dropped': stream.slot.drops.total,
+                    'next_frame_ms': round(1000.0 / stream.max_fps)}), 202
+
+@app.route('/api/stream/<session_id>/events')
+def api_stream_events(session_id):
+    """Server-Sent Events: ready, detected, stats and end"""
+    from flask import Response
+    if not validate_session():
+        return jsonify({'error': 'Not authenticated'}), 401
+    stream = STREAM_SESSIONS.get(session_id, session['teacher_id'])
+    if stream is None:
+        return jsonify({'error': 'No such streaming session'}), 404
+    return Response(stream.events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/stream/<session_id>/stop', methods=['POST'])
+def api_stream_stop(session_id):
+    if not validate_session():
+        return jsonify({'error': 'Not authenticated'}), 401
+    stream = STREAM_SESSIONS.get(session_id, session['teacher_id'])
+    if stream is None:
+        return jsonify({'error': 'No such streaming session'}), 404
+    stream.close('stopped')
+    debug_print(f"stream {stream.id[:6]} stopped students={len(stream.seen)}")
+    return jsonify({'success': True, 'students': stream.students(), 'stats': stream.stats()})
+
 @app.route('/')
 def index():
     if 'teacher_id' in session:
@@ -534,8 +1099,10 @@ def take_attendance():
     students = Student.query.all()
     # Convert Student objects to dictionaries for JSON serialization
     students_data = [student.to_dict() for student in students]
+    classes = sorted({student.class_name for student in students})
     
-    return render_template('take_attendance.html', students=students_data)
+    return render_template('take_attendance.html', students=students_data, classes=classes,
+                           selected_class=session.get('attendance_class', ''), burst_frames=BURST_FRAMES)
 
 @app.route('/api/process_attendance', methods=['POST'])
 def process_attendance():
@@ -1002,10 +1569,15 @@ def add_student():
         return redirect(url_for('login'))
     
     if request.method == 'POST':
-        name = request.form['name']
+        name = request.form['name'].strip()
         roll_number = request.form['roll_number']
         class_name = request.form['class_name']
         
+        # The name doubles as the student's dataset folder name
+        if _dataset_folder(name) is None:
+            flash('Student names cannot contain path separators or start with "."', 'error')
+            return render_template('add_student.html')
+
         # Check if roll number already exists
         if Student.query.filter_by(roll_number=roll_number).first():
             flash('Roll number already exists', 'error')
@@ -1020,12 +1592,30 @@ def add_student():
         
         db.session.add(student)
         db.session.commit()
+        # Put any existing dataset images of this student into their class partition
+        _refresh_class_partitions()
         
         flash('Student added successfully!', 'success')
         return redirect(url_for('dashboard'))
     
     return render_template('add_student.html')
 
+def _dataset_folder(name):
+    """dataset/<name> if the student name is a single safe folder name, else None"""
+    if not name or name.startswith('.') or '\x00' in name or \
+            any(sep in name for sep in ('/', '\\', os.sep, os.altsep) if sep):
+        return None
+    return os.path.join('dataset', name)
+
+def _restore_folder(moved_to, folder):
+    """Put back a dataset folder an edit moved, and let the watcher notice"""
+    try:
+        if moved_to and os.path.isdir(moved_to) and not os.path.exists(folder):
+            os.rename(moved_to, folder)
+    except Exception as e:
+        print(f"⚠️  Could not restore dataset folder {folder} from {moved_to}: {e}")
+    DATASET_WATCHER.request_scan()
+
 @app.route('/remove_student', methods=['POST'])
 def remove_student():
     if not validate_session():
@@ -1040,24 +1630,32 @@ def remove_student():
             flash('Student not found', 'error')
             return redirect(url_for('dashboard'))
 
-        # Delete attendance records for this student
+        # Delete attendance records and the student entry; committed last
         Attendance.query.filter_by(student_id=student.id).delete()
-        # Delete student entry
         db.session.delete(student)
-        db.session.commit()
-
-        # Remove dataset folder if exists
-        dataset_folder = os.path.join('dataset', student.name)
+        db.session.flush()
+
+        # Move the dataset folder aside and drop the student's gallery rows in
+        # place; the folder is only deleted once the database commit succeeded
+        dataset_folder = _dataset_folder(student.name)
+        removed = {'path': None}
+        def remove_folder():
+            if dataset_folder and os.path.isdir(dataset_folder):
+                os.makedirs(REMOVED_DATASET_DIR, exist_ok=True)
+                removed['path'] = os.path.join(REMOVED_DATASET_DIR, f"{student.name}-{secrets.token_hex(4)}")
+                os.rename(dataset_folder, removed['path'])
         try:
-            if os.path.isdir(dataset_folder):
-                shutil.rmtree(dataset_folder)
-        except Exception as e:
-            print(f"⚠️  Could not remove dataset folder {dataset_folder}: {e}")
-
-        # Invalidate encodings cache
-        KNOWN_FACE_DATA['encodings'] = []
-        KNOWN_FACE_DATA['names'] = []
-        KNOWN_FACE_DATA['dataset_mtime'] = 0.0
+            _edit_gallery(
+                remove_folder,
+                lambda path, gallery, mtime: remove_students(path, gallery, [student.name], dataset_mtime=mtime)
+            )
+            db.session.commit()
+        except Exception:
+            # The next gallery sync picks the restored images up again
+            _restore_folder(removed['path'], dataset_folder)
+            raise
+        if removed['path']:
+            shutil.rmtree(removed['path'], ignore_errors=True)
         flash('Student removed successfully', 'success')
     except Exception as e:
         db.session.rollback()
@@ -1065,6 +1663,80 @@ def remove_student():
         print(f"ERROR: remove_student failed: {e}")
     return redirect(url_for('dashboard'))
 
+@app.route('/edit_student', methods=['POST'])
+def edit_student():
+    if not validate_session():
+        return redirect(url_for('login'))
+    try:
+        student = Student.query.get(int(request.form.get('student_id', 0)))
+        if not student:
+            flash('Student not found', 'error')
+            return redirect(url_for('dashboard'))
+
+        name = request.form.get('name', '').strip() or student.name
+        roll_number = request.form.get('roll_number', '').strip() or student.roll_number
+        class_name = request.form.get('class_name', '').strip() or student.class_name
+
+        if roll_number != student.roll_number and Student.query.filter_by(roll_number=roll_number).first():
+            flash('Roll number already exists', 'error')
+            return redirect(url_for('dashboard'))
+
+        old_name = student.name
+        old_class = student.class_name
+        renamed = name != old_name
+        old_folder = _dataset_folder(old_name)
+        new_folder = _dataset_folder(name)
+        if renamed and new_folder is None:
+            flash('Student names cannot contain path separators or start with "."', 'error')
+            return redirect(url_for('dashboard'))
+        if renamed and os.path.exists(new_folder):
+            flash(f'A dataset folder named "{name}" already exists', 'error')
+            return redirect(url_for('dashboard'))
+
+        moved = {'from': None}
+        def rename_folder(source, target):
+            def change():
+                if source and os.path.isdir(source):
+                    os.rename(source, target)
+                    moved['from'] = source
+            return change
+
+        if renamed:
+            # Move the dataset folder and relabel gallery rows without re-encoding
+            try:
+                _edit_gallery(
+                    rename_folder(old_folder, new_folder),
+                    lambda path, gallery, mtime: rename_student(path, gallery, old_name, name, dataset_mtime=mtime)
+                )
+            except Exception:
+                _restore_folder(new_folder if moved['from'] else None, old_folder)
+                raise
+
+        student.name = name
+        student.roll_number = roll_number
+        student.class_name = class_name
+        try:
+            db.session.commit()
+        except Exception:
+            if renamed:
+                # Undo the move and the relabel so folder, gallery and database agree again
+                moved['from'] = None
+                _edit_gallery(
+                    rename_folder(new_folder, old_folder),
+                    lambda path, gallery, mtime: rename_student(path, gallery, name, old_name, dataset_mtime=mtime)
+                )
+            raise
+
+        if renamed or class_name != old_class:
+            # Same rows, new roster: only the class partitions change
+            _refresh_class_partitions()
+        flash('Student updated successfully', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash('Failed to update student', 'error')
+        print(f"ERROR: edit_student failed: {e}")
+    return redirect(url_for('dashboard'))
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
@@ -1081,5 +1753,7 @@ if __name__ == '__main__':
             db.session.commit()
             print("Default teacher created: username='admin', password='admin123'")
     
-    # Disable reloader/threaded mode to avoid native lib crashes with dlib/OpenCV
-    app.run(debug=False, use_reloader=False, threaded=False, host='0.0.0.0', port=5000)
+    # dlib/OpenCV run only in the recognition worker processes, so Flask can be threaded.
+    # The reloader stays off: it would fork a second copy of the pool.
+    RECOGNITION_POOL.start()
+    app.run(debug=False, use_reloader=False, threaded=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,124 @@
+"""
+Cached dataset change detection.
+
+Scanning dataset/ costs one stat per image, so it must stay off the request
+path. DatasetWatcher rescans in a background thread (every `ttl` seconds, or
+immediately on a filesystem event when the optional `watchdog` package is
+installed) and keeps the result in attributes that requests read in O(1).
+"""
+
+import threading
+import time
+
+from gallery_sync import listing_mtime, scan_dataset
+
+
+class DatasetWatcher:
+    """Background dataset scanner exposing an O(1) change fingerprint"""
+
+    def __init__(self, dataset_path="dataset", ttl=2.0, event_ttl=60.0):
+        self.dataset_path = dataset_path
+        self.ttl = ttl                  # poll interval without filesystem events
+        self.event_ttl = event_ttl      # safety poll interval when events are available
+        self.backend = 'polling'
+        self.listing = {}
+        self.mtime = 0.0
+        self.version = 0
+        self.scans = 0
+        self.last_scan_time = 0.0
+        self.last_scan_seconds = 0.0
+        self._wake = threading.Event()
+        self._thread = None
+        self._observer = None
+        self._start_lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+
+    def start(self):
+        """Run the first scan inline, then keep scanning in the background"""
+        if self._thread is not None:
+            return self
+        with self._start_lock:
+            if self._thread is not None:
+                return self
+            self._scan()
+            self._start_events()
+            self._thread = threading.Thread(target=self._run, name='dataset-watcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def request_scan(self):
+        """Ask the background thread to rescan now (e.g. after the app edited dataset/)"""
+        self._wake.set()
+
+    def scan_now(self):
+        """Rescan synchronously, for callers that just edited dataset/ themselves"""
+        self._scan()
+        return self.mtime
+
+    def _start_events(self):
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return
+
+        watcher = self
+
+        class _Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher.request_scan()
+
+        try:
+            observer = Observer()
+            observer.daemon = True
+            observer.schedule(_Handler(), self.dataset_path, recursive=True)
+            observer.start()
+        except Exception as e:
+            print(f"⚠️  Filesystem events unavailable, polling {self.dataset_path} instead: {e}")
+            return
+        self._observer = observer
+        self.backend = 'watchdog'
+
+    def _run(self):
+        while True:
+            interval = self.event_ttl if self._observer is not None else self.ttl
+            self._wake.wait(interval)
+            self._wake.clear()
+            try:
+                self._scan()
+            except Exception as e:
+                print(f"⚠️  Dataset scan failed: {e}")
+
+    def _scan(self):
+        with self._scan_lock:
+            self._scan_locked()
+
+    def _scan_locked(self):
+        started = time.perf_counter()
+        listing = scan_dataset(self.dataset_path)
+        self.last_scan_seconds = time.perf_counter() - started
+        self.last_scan_time = time.time()
+        self.scans += 1
+
+        if listing == self.listing and self.version > 0:
+            return
+        latest = listing_mtime(listing)
+        if self.version > 0:
+            # Deletions and restored old files do not raise the max mtime, so
+            # stamp the change time to keep the fingerprint monotonic.
+            latest = max(latest, self.last_scan_time)
+        # Publish listing before the fingerprint that readers compare against
+        self.listing = listing
+        self.mtime = max(self.mtime, latest)
+        self.version += 1
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'version': self.version,
+            'files': len(self.listing),
+            'dataset_mtime': self.mtime,
+            'scans': self.scans,
+            'last_scan_time': self.last_scan_time,
+            'last_scan_ms': round(self.last_scan_seconds * 1000.0, 2),
+        }
@@ -9,6 +9,7 @@ import face_recognition
 import numpy as np
 import os
 from collections import defaultdict
+from face_matcher import FaceMatcher
 
 def load_known_faces_debug():
     """Load faces with detailed debugging info"""
@@ -89,6 +90,8 @@ def test_recognition_accuracy():
         print("❌ No encodings loaded. Check your dataset folder.")
         return
     
+    matcher = FaceMatcher(known_encodings, known_names)
+    
     print("\n🎯 Testing recognition accuracy...")
     print("Press 'q' to quit, 's' to save current frame")
     
@@ -107,15 +110,10 @@ def test_recognition_accuracy():
         face_locations = face_recognition.face_locations(rgb_small)
         face_encodings = face_recognition.face_encodings(rgb_small, face_locations)
         
-        for face_encoding, face_location in zip(face_encodings, face_locations):
-            # Test different confidence thresholds
-            face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-            best_match_index = np.argmin(face_distances)
-            best_distance = face_distances[best_match_index]
-            
-            # Calculate confidence
-            confidence = max(0, 1 - (best_distance / 0.6))
-            name = known_names[best_match_index] if confidence >= 0.6 else "Unknown"
+        # Match all faces of the frame in one call
+        matches = matcher.match(face_encodings, confidence_threshold=0.6)
+        for (matched_name, best_distance, confidence), face_location in zip(matches, face_locations):
+            name = matched_name if matched_name is not None else "Unknown"
             
             # Draw results
             top, right, bottom, left = [v * 4 for v in face_location]
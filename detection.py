@@ -0,0 +1,408 @@
+"""
+Face detection cascade shared by the web app and the recognition workers.
+
+Kept free of Flask/app state so worker processes can import it cheaply.
+face_recognition (dlib) is only imported by the functions that detect or
+encode, which run in the workers; the web app imports this module for the
+planner and box parsing without loading dlib.
+"""
+
+import json
+import logging
+import math
+import threading
+import time
+
+import cv2
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Frames smaller than this (longest side, px) are searched as if upscaled to it
+DETECT_MIN_SIZE = 400
+# No pyramid level is made larger than this (longest side, px): a large upload
+# is searched at most at this size instead of at 4-5x its own
+DETECT_MAX_LEVEL = 2400
+
+
+def decode_image(buffer):
+    """Decode JPEG/PNG bytes to a BGR frame, or None if they are not an image"""
+    if not buffer:
+        return None
+    return cv2.imdecode(np.frombuffer(buffer, np.uint8), cv2.IMREAD_COLOR)
+
+
+class FramePyramid:
+    """
+    Grayscale pyramid of one frame shared by every cascade stage. The frame
+    is converted to grayscale once; each level is built on first use from
+    the largest cached level below it (a plain pyrUp when it is exactly
+    twice as large), and HOG runs on it without dlib's own upsampling.
+    Boxes are mapped back to original frame coordinates, and the RGB frame
+    is only produced for the final encoding.
+
+    Only the full-size levels and the latest larger level per kind are
+    kept, and levels are capped at `max_level` px, so a cascade over a large
+    frame does not hold every upscaled copy at once.
+    """
+
+    def __init__(self, frame, min_size=DETECT_MIN_SIZE, max_level=DETECT_MAX_LEVEL):
+        self.frame = frame
+        self.height, self.width = frame.shape[:2]
+        log.debug("Decoded frame %dx%d", self.width, self.height)
+        # Very small frames are searched as if upscaled to min_size (0 = as they are)
+        longest = max(self.height, self.width)
+        self.base_scale = float(min_size) / longest if min_size and longest < min_size else 1.0
+        self.max_factor = max(1.0, float(max_level) / longest) if max_level else None
+        self._levels = {(1.0, False): cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)}
+        self._detected = {}   # (factor, enhanced) -> boxes, for stages capped to the same level
+        self._rgb = None
+
+    def level(self, scale, enhanced=False):
+        """Grayscale image at `scale` x the original frame size (CLAHE-equalized if enhanced)"""
+        image = self._levels.get((scale, enhanced))
+        if image is not None:
+            return image
+        if scale == 1.0:
+            # Light enhancement (CLAHE on luminance)
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+            image = clahe.apply(self.level(1.0))
+        else:
+            smaller = [s for s, e in self._levels if e == enhanced and s < scale]
+            source_scale = max(smaller) if smaller else 1.0
+            source = self.level(source_scale, enhanced)
+            if abs(scale - 2.0 * source_scale) < 1e-9:
+                image = cv2.pyrUp(source)
+            else:
+                factor = scale / source_scale
+                image = cv2.resize(source, (0, 0), fx=factor, fy=factor, interpolation=cv2.INTER_LINEAR)
+            # Stages go up in size: smaller upscaled levels of this kind are not needed again
+            for key in [key for key in self._levels if key[1] == enhanced and 1.0 < key[0] < scale]:
+                del self._levels[key]
+        self._levels[(scale, enhanced)] = image
+        return image
+
+    def detect(self, scale, enhanced=False):
+        """HOG detection on one level (relative to the detection base size), in original coordinates"""
+        import face_recognition
+
+        factor = self.base_scale * scale
+        if self.max_factor is not None:
+            factor = min(factor, self.max_factor)
+        if (factor, enhanced) not in self._detected:
+            image = self.level(factor, enhanced)
+            boxes = face_recognition.face_locations(image, number_of_times_to_upsample=0, model="hog")
+            self._detected[(factor, enhanced)] = [self._to_original(box, factor) for box in boxes]
+        return self._detected[(factor, enhanced)]
+
+    def _to_original(self, box, factor):
+        top, right, bottom, left = box
+        return (max(int(round(top / factor)), 0), min(int(round(right / factor)), self.width - 1),
+                min(int(round(bottom / factor)), self.height - 1), max(int(round(left / factor)), 0))
+
+    def rgb(self):
+        if self._rgb is None:
+            self._rgb = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
+        return self._rgb
+
+
+# Each stage reproduces one pass of the original cascade; dlib's "upsample n"
+# is a level 2**n times larger.
+def _stage_hog(pyramid):
+    # Lean fast-path detection: assume client already downscaled
+    return pyramid.detect(2.0)
+
+
+def _stage_hog_upsample2(pyramid):
+    # One extra upsample pass
+    return pyramid.detect(4.0)
+
+
+def _stage_hog_rescale(pyramid):
+    # Slightly larger scale
+    return pyramid.detect(5.0)
+
+
+def _stage_clahe(pyramid):
+    return pyramid.detect(4.0, enhanced=True)
+
+
+CASCADE_STAGES = {
+    'hog': _stage_hog,
+    'hog_upsample2': _stage_hog_upsample2,
+    'hog_rescale': _stage_hog_rescale,
+    'clahe': _stage_clahe,
+}
+DEFAULT_STAGES = ('hog', 'hog_upsample2', 'hog_rescale', 'clahe')
+
+
+def run_cascade(frame, stages=DEFAULT_STAGES, budget_ms=None, expected_ms=None, min_size=DETECT_MIN_SIZE):
+    """
+    Try detection stages in order until one finds a face. A stage is not
+    started if the time spent plus its expected cost would exceed budget_ms
+    (the first stage always runs). Returns (rgb frame or None when no face
+    was found, face_locations in frame coordinates, report) where report
+    lists the stages tried. `min_size` is passed to FramePyramid.
+    """
+    started = time.perf_counter()
+    pyramid = FramePyramid(frame, min_size)
+    expected_ms = expected_ms or {}
+    report = {'stage': None, 'tried': [], 'budget_exhausted': False}
+    face_locations = []
+    for i, name in enumerate(stages):
+        elapsed = (time.perf_counter() - started) * 1000.0
+        if i > 0 and budget_ms and elapsed + expected_ms.get(name, 0.0) > budget_ms:
+            report['budget_exhausted'] = True
+            break
+        stage_started = time.perf_counter()
+        try:
+            face_locations = CASCADE_STAGES[name](pyramid)
+        except Exception:
+            face_locations = []
+        report['tried'].append((name, round((time.perf_counter() - stage_started) * 1000.0, 2),
+                                len(face_locations) > 0))
+        if face_locations:
+            report['stage'] = name
+            break
+    report['elapsed_ms'] = round((time.perf_counter() - started) * 1000.0, 2)
+    return (pyramid.rgb() if face_locations else None), face_locations, report
+
+
+def detect_faces(frame):
+    """Run the full cascade on one BGR frame; returns (rgb frame or None, face_locations)"""
+    rgb, face_locations, _ = run_cascade(frame)
+    return rgb, face_locations
+
+
+class CascadePlanner:
+    """
+    Learns per profile (e.g. one classroom's camera) how often each stage
+    finds the faces and what it costs. Stages that have been tried enough
+    are reordered by hits per millisecond; ones that almost never help are
+    skipped, except on every explore_every-th frame so they can come back.
+    """
+
+    def __init__(self, stages=DEFAULT_STAGES, budget_ms=None, adaptive=True, min_runs=30,
+                 skip_below=0.02, explore_every=20, min_size=DETECT_MIN_SIZE):
+        unknown = [name for name in stages if name not in CASCADE_STAGES]
+        if unknown:
+            raise ValueError(f"Unknown detection stages: {unknown}")
+        self.stages = list(stages)
+        self.budget_ms = budget_ms
+        self.adaptive = adaptive
+        self.min_runs = min_runs
+        self.skip_below = skip_below
+        self.explore_every = explore_every
+        self.min_size = min_size      # see FramePyramid; 0 for frames already sized for detection
+        self._profiles = {}   # profile -> {'frames': n, 'stages': {name: [runs, hits, total_ms]}}
+        self._lock = threading.Lock()
+
+    def _profile(self, profile):
+        entry = self._profiles.get(profile)
+        if entry is None:
+            entry = {'frames': 0, 'partial': 0, 'detect_ms': 0.0, 'client_frames': 0, 'saved_ms': 0.0,
+                     'stages': {name: [0, 0, 0.0] for name in CASCADE_STAGES}}
+            self._profiles[profile] = entry
+        return entry
+
+    def plan(self, profile=None, budget_ms=None):
+        """Stage order, budget and expected stage costs for the next frame"""
+        with self._lock:
+            entry = self._profile(profile)
+            stats = entry['stages']
+            expected = {name: stats[name][2] / stats[name][0] for name in self.stages if stats[name][0]}
+            order = list(self.stages)
+            if self.adaptive:
+                mature = [i for i, name in enumerate(order) if stats[name][0] >= self.min_runs]
+                ranked = sorted((order[i] for i in mature),
+                                key=lambda name: -stats[name][1] / max(stats[name][2], 1e-3))
+                for i, name in zip(mature, ranked):
+                    order[i] = name
+                exploring = self.explore_every and entry['frames'] % self.explore_every == 0
+                if not exploring:
+                    kept = [name for name in order
+                            if stats[name][0] < self.min_runs or stats[name][1] / stats[name][0] >= self.skip_below]
+                    order = kept or order[:1]
+        return {'stages': order, 'budget_ms': budget_ms or self.budget_ms, 'expected_ms': expected,
+                'min_size': self.min_size}
+
+    def record(self, profile, report):
+        with self._lock:
+            entry = self._profile(profile)
+            entry['frames'] += 1
+            entry['partial'] += bool(report.get('budget_exhausted'))
+            entry['detect_ms'] += report.get('elapsed_ms', 0.0)
+            for name, ms, found in report.get('tried', []):
+                stats = entry['stages'][name]
+                stats[0] += 1
+                stats[1] += bool(found)
+                stats[2] += ms
+
+    def record_skipped(self, profile, verify_ms=0.0):
+        """
+        Account for a frame whose faces came from the client. Returns the
+        detection time saved, estimated from this profile's mean cascade time
+        (None until the cascade has run there).
+        """
+        with self._lock:
+            entry = self._profile(profile)
+            entry['client_frames'] += 1
+            if not entry['frames']:
+                return None
+            saved = max(0.0, entry['detect_ms'] / entry['frames'] - verify_ms)
+            entry['saved_ms'] += saved
+            return saved
+
+    def stats(self):
+        with self._lock:
+            profiles = {}
+            for profile, entry in self._profiles.items():
+                profiles[profile or 'all'] = {
+                    'frames': entry['frames'],
+                    'partial': entry['partial'],
+                    'mean_detect_ms': round(entry['detect_ms'] / entry['frames'], 1) if entry['frames'] else None,
+                    'client_frames': entry['client_frames'],
+                    'detection_ms_saved': round(entry['saved_ms'], 1),
+                    'stages': {
+                        name: {'runs': runs, 'hit_rate': round(hits / runs, 3),
+                               'mean_ms': round(total_ms / runs, 1)}
+                        for name, (runs, hits, total_ms) in entry['stages'].items() if runs
+                    },
+                }
+        return {'stages': self.stages, 'budget_ms': self.budget_ms, 'adaptive': self.adaptive,
+                'profiles': profiles}
+
+
+def encode_faces(detections):
+    """
+    Encode the faces of several images in one batched dlib call.
+    `detections` is a list of (rgb image, face_locations); returns one list
+    of encodings per image. Landmarks come from face_recognition's private
+    _raw_face_landmarks helper; an image for which it is missing or fails
+    is encoded with the public face_encodings() instead.
+    """
+    import face_recognition
+
+    try:
+        import dlib
+        from face_recognition import api
+        raw_landmarks = api._raw_face_landmarks
+        face_encoder = api.face_encoder
+    except (ImportError, AttributeError):
+        raw_landmarks = None
+
+    results = [[] for _ in detections]
+    batch, images, shapes = [], [], []
+    for i, (rgb, face_locations) in enumerate(detections):
+        if not face_locations:
+            continue
+        landmarks = None
+        if raw_landmarks is not None:
+            try:
+                landmarks = dlib.full_object_detections()
+                for landmark in raw_landmarks(rgb, face_locations, model="small"):
+                    landmarks.append(landmark)
+            except Exception:
+                landmarks = None
+        if landmarks is None:
+            results[i] = face_recognition.face_encodings(rgb, face_locations)
+            continue
+        batch.append(i)
+        images.append(rgb)
+        shapes.append(landmarks)
+
+    if images:
+        try:
+            # Batch overload: list of images with a list of landmark sets
+            descriptors = face_encoder.compute_face_descriptor(images, shapes, 1)
+        except (TypeError, RuntimeError):
+            # dlib too old for batched descriptors: encode image by image
+            descriptors = [face_recognition.face_encodings(*detections[i]) for i in batch]
+        for i, faces in zip(batch, descriptors):
+            results[i] = [np.array(descriptor) for descriptor in faces]
+    return results
+
+
+MAX_CLIENT_BOXES = 32
+
+
+def _box_coord(value):
+    """One box coordinate as a float; NaN/Infinity would overflow int()"""
+    coord = float(value)
+    if not math.isfinite(coord):
+        raise ValueError("box coordinates must be finite numbers")
+    return coord
+
+
+def parse_client_boxes(value):
+    """
+    Parse client-supplied face boxes: a list (or its JSON string) of
+    [top, right, bottom, left] or {x, y, width, height}. Raises ValueError.
+    """
+    if isinstance(value, str):
+        value = json.loads(value) if value.strip() else []
+    if not isinstance(value, list):
+        raise ValueError("boxes must be a list")
+    if len(value) > MAX_CLIENT_BOXES:
+        raise ValueError(f"At most {MAX_CLIENT_BOXES} boxes per frame")
+    boxes = []
+    for box in value:
+        if isinstance(box, dict):
+            x, y = _box_coord(box['x']), _box_coord(box['y'])
+            right, bottom = x + _box_coord(box['width']), y + _box_coord(box['height'])
+            if not (math.isfinite(right) and math.isfinite(bottom)):
+                raise ValueError("box coordinates must be finite numbers")
+            boxes.append((int(y), int(right), int(bottom), int(x)))
+        elif isinstance(box, (list, tuple)) and len(box) == 4:
+            boxes.append(tuple(int(_box_coord(v)) for v in box))
+        else:
+            raise ValueError("each box must be [top, right, bottom, left] or {x, y, width, height}")
+    return boxes
+
+
+def verify_boxes(frame, boxes, min_size=20, max_aspect=2.0, min_contrast=8.0):
+    """
+    Cheap sanity check of client boxes instead of running detection: clip to
+    the frame and drop boxes that are tiny, badly shaped or flat (no
+    texture). Returns (kept boxes, number rejected).
+    """
+    height, width = frame.shape[:2]
+    kept = []
+    for top, right, bottom, left in boxes:
+        top, left = max(top, 0), max(left, 0)
+        bottom, right = min(bottom, height - 1), min(right, width - 1)
+        box_h, box_w = bottom - top, right - left
+        if box_h < min_size or box_w < min_size or max(box_h / box_w, box_w / box_h) > max_aspect:
+            continue
+        crop = frame[top:bottom, left:right]
+        if float(crop.std()) < min_contrast:
+            continue
+        kept.append((top, right, bottom, left))
+    return kept, len(boxes) - len(kept)
+
+
+def client_faces(frame, boxes, verify=True):
+    """
+    Skip the cascade for faces the client already found. Returns the same
+    (rgb frame or None, face_locations, report) as run_cascade(). With
+    verify=False (boxes from our own detector) every box is kept, only
+    clipped to the frame, so the encodings line up with `boxes`.
+    """
+    started = time.perf_counter()
+    if verify:
+        face_locations, rejected = verify_boxes(frame, boxes)
+    else:
+        height, width = frame.shape[:2]
+        face_locations = [(max(top, 0), min(right, width - 1), min(bottom, height - 1), max(left, 0))
+                          for top, right, bottom, left in boxes]
+        rejected = 0
+    report = {'stage': 'client', 'tried': [], 'budget_exhausted': False, 'rejected_boxes': rejected,
+              'elapsed_ms': round((time.perf_counter() - started) * 1000.0, 2)}
+    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if face_locations else None
+    return rgb, face_locations, report
+
+
+def detect_and_encode(frame):
+    """Detect and encode the faces of one BGR frame; returns (face_locations, face_encodings)"""
+    rgb, face_locations = detect_faces(frame)
+    return face_locations, encode_faces([(rgb, face_locations)])[0]
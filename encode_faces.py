@@ -1,72 +1,45 @@
-import face_recognition
+import argparse
 import os
-import pickle
-from collections import defaultdict
+from collections import Counter
+from gallery_sync import listing_mtime, scan_dataset, sync_gallery
 
 dataset_path = "dataset"
-encodings = []
-names = []
-per_student_counts = defaultdict(int)
-
-# Loop through all student folders
-valid_exts = {".jpg", ".jpeg", ".png"}
-for student in os.listdir(dataset_path):
-    student_folder = os.path.join(dataset_path, student)
-
-    if not os.path.isdir(student_folder):
-        continue
-
-    for file in os.listdir(student_folder):
-        ext = os.path.splitext(file)[1].lower()
-        if ext not in valid_exts:
-            continue
-
-        img_path = os.path.join(student_folder, file)
-
-        try:
-            # Load image and detect face locations with mild upsampling for small faces
-            image = face_recognition.load_image_file(img_path)
-            face_locations = face_recognition.face_locations(
-                image,
-                number_of_times_to_upsample=1,
-                model="hog"
-            )
-
-            if len(face_locations) == 0:
-                print(f"❌ No face found in {student}/{file}, skipping...")
-                continue
-
-            # If multiple faces, pick the largest face (likely the subject)
-            if len(face_locations) > 1:
-                def box_area(box):
-                    top, right, bottom, left = box
-                    return max(0, bottom - top) * max(0, right - left)
-                face_locations.sort(key=box_area, reverse=True)
-                face_locations = [face_locations[0]]
-
-            face_encs = face_recognition.face_encodings(image, face_locations)
-            if not face_encs:
-                print(f"❌ Could not compute encoding in {student}/{file}, skipping...")
-                continue
-
-            encoding = face_encs[0]
-            encodings.append(encoding)
-            names.append(student)
-            per_student_counts[student] += 1
-
-        except Exception as e:
-            print(f"⚠️  Error processing {student}/{file}: {e}")
-
-# Save encodings to file
-data = {"encodings": encodings, "names": names}
-with open("encodings.pkl", "wb") as f:
-    pickle.dump(data, f)
-
-# Summary
-unique_students = len(set(names))
-total_encodings = len(encodings)
-print("✅ Encodings generated & saved to encodings.pkl")
-print(f"✅ Total students encoded: {unique_students}")
-print(f"✅ Total encodings saved: {total_encodings}")
-for student, cnt in sorted(per_student_counts.items()):
-    print(f"   - {student}: {cnt} encodings")
+gallery_path = "gallery.bin"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode dataset/ faces into gallery.bin")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="encoding processes (default: all cores)")
+    parser.add_argument("--checkpoint-seconds", type=float, default=30.0,
+                        help="save progress this often so an interrupted run can resume")
+    args = parser.parse_args()
+
+    if not os.path.isdir(dataset_path):
+        print(f"❌ Dataset folder '{dataset_path}' not found")
+        raise SystemExit(1)
+
+    # Fingerprint taken before encoding so later edits still mark the gallery stale
+    listing = scan_dataset(dataset_path)
+    dataset_mtime = listing_mtime(listing)
+
+    # Only new or changed images are encoded; delete gallery.bin to force a full rebuild
+    print(f"🚀 Encoding {len(listing)} images with {args.workers} worker(s)...")
+    try:
+        gallery = sync_gallery(gallery_path, dataset_path=dataset_path, dataset_mtime=dataset_mtime,
+                               current=listing, workers=args.workers,
+                               checkpoint_seconds=args.checkpoint_seconds)
+    except KeyboardInterrupt:
+        raise SystemExit(130)
+
+    # Summary
+    per_student_counts = Counter(gallery.names)
+    print(f"✅ Encodings generated & saved to {gallery_path}")
+    print(f"✅ Total students encoded: {len(per_student_counts)}")
+    print(f"✅ Total encodings saved: {len(gallery)}")
+    for student, cnt in sorted(per_student_counts.items()):
+        print(f"   - {student}: {cnt} encodings")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Batched face matching against a contiguous float32 gallery.
+
+The gallery is kept as one preallocated (N, 128) float32 matrix with the
+squared row norms computed once, so matching all faces of a frame is a
+single matrix product instead of one face_distance() call per face.
+"""
+
+import time
+
+import numpy as np
+
+ENCODING_DIM = 128
+
+# face_recognition uses 0.6 as its default tolerance; confidence is scaled against it
+DISTANCE_TOLERANCE = 0.6
+
+
+def distance_to_confidence(distance):
+    """Convert a face distance to a 0-1 confidence (higher is better)"""
+    return max(0.0, 1.0 - (float(distance) / DISTANCE_TOLERANCE))
+
+
+def as_encoding_matrix(encodings):
+    """Copy a list/array of encodings into one contiguous float32 (N, 128) matrix"""
+    if isinstance(encodings, np.ndarray) and encodings.ndim == 2:
+        return np.ascontiguousarray(encodings, dtype=np.float32)
+    matrix = np.empty((len(encodings), ENCODING_DIM), dtype=np.float32)
+    for i, encoding in enumerate(encodings):
+        matrix[i] = encoding
+    return matrix
+
+
+class FaceMatcher:
+    """Match many face encodings against the known gallery in one call"""
+
+    def __init__(self, encodings, names):
+        if len(encodings) != len(names):
+            raise ValueError(f"Got {len(encodings)} encodings but {len(names)} names")
+        self.matrix = as_encoding_matrix(encodings)
+        self.names = list(names)
+        # Precomputed |g|^2 per gallery row
+        self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+
+    def __len__(self):
+        return len(self.names)
+
+    def subset(self, rows):
+        """A matcher over the given gallery rows only (e.g. one class roster)"""
+        rows = np.asarray(rows, dtype=np.intp)
+        return FaceMatcher(self.matrix[rows], [self.names[i] for i in rows])
+
+    def distances(self, face_encodings):
+        """Euclidean distances, shape (faces, gallery)"""
+        queries = as_encoding_matrix(face_encodings)
+        if len(queries) == 0 or len(self.names) == 0:
+            return np.empty((len(queries), len(self.names)), dtype=np.float32)
+        q_sq = np.einsum('ij,ij->i', queries, queries)
+        # |q - g|^2 = |q|^2 + |g|^2 - 2 q.g
+        sq = queries @ self.matrix.T
+        sq *= -2.0
+        sq += q_sq[:, None]
+        sq += self.sq_norms[None, :]
+        np.maximum(sq, 0.0, out=sq)
+        return np.sqrt(sq, out=sq)
+
+    def match(self, face_encodings, confidence_threshold=0.6):
+        """
+        Match every face of a frame at once.
+        Returns a list of (name, distance, confidence) per face; name is None
+        when the best match is below the confidence threshold.
+        """
+        if len(face_encodings) == 0:
+            return []
+        if len(self.names) == 0:
+            return [(None, float('inf'), 0.0) for _ in range(len(face_encodings))]
+
+        dists = self.distances(face_encodings)
+        best_idx = np.argmin(dists, axis=1)
+        best_dist = dists[np.arange(len(best_idx)), best_idx]
+
+        results = []
+        for idx, distance in zip(best_idx, best_dist):
+            confidence = distance_to_confidence(distance)
+            name = self.names[idx] if confidence >= confidence_threshold else None
+            results.append((name, float(distance), confidence))
+        return results
+
+
+class PrototypeMatcher:
+    """
+    Two-stage matcher: compare faces with one centroid per student, then
+    re-score only the top_k closest students against all their exemplars.
+    Per-student sums/counts are kept so a new gallery version updates the
+    centroids from the rows that changed instead of recomputing them all.
+    """
+
+    def __init__(self, matcher, keys, top_k=5, sums=None, counts=None, rows_by_label=None, row_of=None):
+        if len(keys) != len(matcher):
+            raise ValueError(f"Got {len(keys)} keys for {len(matcher)} gallery rows")
+        self.matcher = matcher
+        self.keys = list(keys)
+        self.top_k = top_k
+        if sums is None:
+            sums, counts = {}, {}
+            for row, name in enumerate(matcher.names):
+                if name not in sums:
+                    sums[name] = np.zeros(ENCODING_DIM, dtype=np.float64)
+                    counts[name] = 0
+                sums[name] += matcher.matrix[row]
+                counts[name] += 1
+        self.sums = sums
+        self.counts = counts
+        self.row_of = row_of if row_of is not None else {key: row for row, key in enumerate(self.keys)}
+
+        self.labels = sorted(name for name, count in counts.items() if count > 0)
+        self.centroids = np.empty((len(self.labels), ENCODING_DIM), dtype=np.float32)
+        for i, name in enumerate(self.labels):
+            self.centroids[i] = sums[name] / counts[name]
+        self.c_sq = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        if rows_by_label is None:
+            groups = {name: [] for name in self.labels}
+            for row, name in enumerate(matcher.names):
+                groups[name].append(row)
+            rows_by_label = {name: np.asarray(rows, dtype=np.intp) for name, rows in groups.items()}
+        self.rows_by_label = [rows_by_label[name] for name in self.labels]
+
+    def __len__(self):
+        return len(self.matcher)
+
+    def stats(self):
+        return {'students': len(self.labels), 'encodings': len(self.matcher), 'top_k': self.top_k}
+
+    def updated(self, matcher, keys):
+        """
+        A new PrototypeMatcher for the next gallery version, updated
+        incrementally: rows whose key, name and vector are unchanged are
+        carried over, everything else is subtracted from / added to the
+        per-student sums. Row groups of untouched students are only renumbered.
+        """
+        keys = list(keys)
+        new_rows = {key: row for row, key in enumerate(keys)}
+        kept_old, kept_new = [], []
+        for key, row in new_rows.items():
+            old_row = self.row_of.get(key)
+            if old_row is not None and self.matcher.names[old_row] == matcher.names[row]:
+                kept_old.append(old_row)
+                kept_new.append(row)
+        kept_old = np.asarray(kept_old, dtype=np.intp)
+        kept_new = np.asarray(kept_new, dtype=np.intp)
+        if len(kept_old):
+            # Same image path re-encoded in place (edited file): treat as removed + added
+            same = np.all(self.matcher.matrix[kept_old] == matcher.matrix[kept_new], axis=1)
+            kept_old, kept_new = kept_old[same], kept_new[same]
+        remap = np.full(len(self.keys), -1, dtype=np.intp)
+        remap[kept_old] = kept_new
+        added = np.ones(len(keys), dtype=bool)
+        added[kept_new] = False
+
+        sums = {name: total.copy() for name, total in self.sums.items()}
+        counts = dict(self.counts)
+        touched = set()
+        for row in np.flatnonzero(remap < 0):
+            name = self.matcher.names[row]
+            sums[name] -= self.matcher.matrix[row]
+            counts[name] -= 1
+            touched.add(name)
+        added_rows = {}
+        for row in np.flatnonzero(added):
+            name = matcher.names[row]
+            if name not in sums:
+                sums[name] = np.zeros(ENCODING_DIM, dtype=np.float64)
+                counts[name] = 0
+            sums[name] += matcher.matrix[row]
+            counts[name] += 1
+            touched.add(name)
+            added_rows.setdefault(name, []).append(row)
+        for name in [name for name, count in counts.items() if count <= 0]:
+            del sums[name], counts[name]
+
+        rows_by_label = {}
+        for name, rows in zip(self.labels, self.rows_by_label):
+            moved = remap[rows]
+            rows_by_label[name] = moved if name not in touched else moved[moved >= 0]
+        for name in touched:
+            if name in counts:
+                rows = np.concatenate([rows_by_label.get(name, np.empty(0, dtype=np.intp)),
+                                       np.asarray(added_rows.get(name, []), dtype=np.intp)])
+                rows_by_label[name] = np.sort(rows)
+        return PrototypeMatcher(matcher, keys, self.top_k, sums, counts, rows_by_label, new_rows)
+
+    def match(self, face_encodings, confidence_threshold=0.6, top_k=None):
+        """Same contract as FaceMatcher.match()"""
+        if len(face_encodings) == 0:
+            return []
+        if len(self.labels) == 0:
+            return [(None, float('inf'), 0.0) for _ in range(len(face_encodings))]
+        top_k = min(top_k or self.top_k, len(self.labels))
+        queries = as_encoding_matrix(face_encodings)
+        q_sq = np.einsum('ij,ij->i', queries, queries)
+
+        # Stage 1: nearest student centroids
+        coarse = queries @ self.centroids.T
+        coarse *= -2.0
+        coarse += q_sq[:, None]
+        coarse += self.c_sq[None, :]
+        candidates = np.argpartition(coarse, top_k - 1, axis=1)[:, :top_k]
+
+        # Stage 2: exact distances to those students' exemplars only
+        results = []
+        for qi in range(len(queries)):
+            rows = np.concatenate([self.rows_by_label[label] for label in candidates[qi]])
+            sq = self.matcher.sq_norms[rows] - 2.0 * (self.matcher.matrix[rows] @ queries[qi]) + q_sq[qi]
+            j = int(np.argmin(sq))
+            distance = float(np.sqrt(max(float(sq[j]), 0.0)))
+            confidence = distance_to_confidence(distance)
+            name = self.matcher.names[rows[j]] if confidence >= confidence_threshold else None
+            results.append((name, distance, confidence))
+        return results
+
+
+def measure_agreement(candidate, exact, queries, confidence_threshold=0.6):
+    """How often `candidate` makes the same decision as the exact matcher, and at what cost"""
+    queries = as_encoding_matrix(queries)
+    started = time.perf_counter()
+    expected = exact.match(queries, confidence_threshold)
+    exact_ms = (time.perf_counter() - started) * 1000.0 / max(len(queries), 1)
+    started = time.perf_counter()
+    got = candidate.match(queries, confidence_threshold)
+    candidate_ms = (time.perf_counter() - started) * 1000.0 / max(len(queries), 1)
+    same = sum(g[0] == e[0] for g, e in zip(got, expected))
+    deltas = [abs(g[1] - e[1]) for g, e in zip(got, expected)]
+    return {
+        'decision_agreement': same / max(len(queries), 1),
+        'max_distance_delta': max(deltas, default=0.0),
+        'ms_per_query': round(candidate_ms, 3),
+        'exact_ms_per_query': round(exact_ms, 3),
+    }
@@ -0,0 +1,226 @@
+"""
+Tracking-by-detection for live video.
+
+Full face detection runs every `detect_every` frames, or sooner when the
+scene changes (frame difference) or a track loses its feature points. In
+between, faces are followed with pyramidal Lucas-Kanade optical flow on a
+few corner points per face. Encodings are only computed for new tracks
+(including lost-and-reacquired faces) and for tracks still unidentified,
+so students sitting still are recognized once instead of on every frame.
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+from frame_gate import route_stages
+
+_LK_PARAMS = dict(winSize=(15, 15), maxLevel=2,
+                  criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+
+def box_iou(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes"""
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    inter = max(0.0, bottom - top) * max(0.0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - inter
+    return inter / union if union > 0 else 0.0
+
+
+class Track:
+    """One face followed across frames"""
+
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = tuple(float(v) for v in box)
+        self.points = None
+        self.name = None
+        self.distance = float('inf')
+        self.confidence = 0.0
+        self.misses = 0      # detection passes in a row that did not see this face
+        self.encoded = False
+
+    def int_box(self):
+        return tuple(int(round(v)) for v in self.box)
+
+
+class FaceTracker:
+    """Follow faces between detections and re-encode only when needed"""
+
+    def __init__(self, detect_every=10, motion_threshold=12.0, iou_threshold=0.3, max_misses=2, min_points=4):
+        self.detect_every = detect_every
+        self.motion_threshold = motion_threshold   # mean abs difference (0-255) that forces detection
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.min_points = min_points
+        self.tracks = []
+        self.frames = 0
+        self.detections = 0
+        self.encodings = 0
+        self._next_id = 1
+        self._prev_gray = None
+        self._motion_ref = None
+        self._since_detection = 0
+        self._started = time.time()
+        self._cpu_started = time.process_time()
+        self._window = (time.time(), time.process_time(), 0)
+        self.fps = 0.0
+        self.cpu_percent = 0.0
+
+    def _seed_points(self, gray, track):
+        top, right, bottom, left = track.int_box()
+        mask = np.zeros_like(gray)
+        # Inner part of the box: avoids corners on the background
+        pad_y, pad_x = (bottom - top) // 6, (right - left) // 6
+        mask[max(top + pad_y, 0):max(bottom - pad_y, 0), max(left + pad_x, 0):max(right - pad_x, 0)] = 255
+        track.points = cv2.goodFeaturesToTrack(gray, maxCorners=30, qualityLevel=0.01, minDistance=3, mask=mask)
+
+    def _flow(self, gray):
+        """Move every track by the median flow of its points; returns True if one was lost"""
+        lost = False
+        for track in self.tracks:
+            if track.points is None or len(track.points) < self.min_points:
+                # Too little texture to follow: the box waits for the next detection
+                continue
+            new_points, status, _ = cv2.calcOpticalFlowPyrLK(self._prev_gray, gray, track.points, None, **_LK_PARAMS)
+            good = status.reshape(-1) == 1
+            if good.sum() < self.min_points:
+                # Occluded or moved too fast: re-detect now
+                track.points = None
+                lost = True
+                continue
+            dx, dy = np.median((new_points[good] - track.points[good]).reshape(-1, 2), axis=0)
+            top, right, bottom, left = track.box
+            track.box = (top + dy, right + dx, bottom + dy, left + dx)
+            track.points = new_points[good].reshape(-1, 1, 2)
+        return lost
+
+    def _motion(self, gray):
+        thumb = cv2.resize(gray, (80, 60), interpolation=cv2.INTER_AREA)
+        if self._motion_ref is None:
+            return float('inf'), thumb
+        return float(cv2.absdiff(thumb, self._motion_ref).mean()), thumb
+
+    def _associate(self, gray, boxes):
+        """Match detected boxes to tracks by IoU; returns tracks that need an encoding"""
+        unmatched = list(range(len(self.tracks)))
+        to_encode = []
+        for box in boxes:
+            best, best_iou = None, self.iou_threshold
+            for i in unmatched:
+                iou = box_iou(self.tracks[i].box, box)
+                if iou >= best_iou:
+                    best, best_iou = i, iou
+            if best is None:
+                track = Track(self._next_id, box)
+                self._next_id += 1
+                self.tracks.append(track)
+            else:
+                unmatched.remove(best)
+                track = self.tracks[best]
+                track.box = tuple(float(v) for v in box)
+                track.misses = 0
+            self._seed_points(gray, track)
+            if not track.encoded or track.name is None:
+                to_encode.append(track)
+        for i in unmatched:
+            self.tracks[i].misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+        return to_encode
+
+    def update(self, frame, detect, encode, match):
+        """
+        Process one BGR frame. `detect(frame)` returns face boxes,
+        `encode(frame, boxes)` their encodings and `match(encodings)` a list
+        of (name, distance, confidence). Returns the live tracks.
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.frames += 1
+        self._since_detection += 1
+
+        lost = self._flow(gray) if self._prev_gray is not None and self.tracks else False
+        motion, thumb = self._motion(gray)
+        if lost or not self.tracks or motion > self.motion_threshold or self._since_detection >= self.detect_every:
+            self.detections += 1
+            self._since_detection = 0
+            self._motion_ref = thumb
+            to_encode = self._associate(gray, detect(frame))
+            if to_encode:
+                encodings = encode(frame, [track.int_box() for track in to_encode])
+                self.encodings += len(to_encode)
+                for track, (name, distance, confidence) in zip(to_encode, match(encodings)):
+                    track.name, track.distance, track.confidence = name, distance, confidence
+                    track.encoded = True
+
+        self._prev_gray = gray
+        self._update_rates()
+        return [track for track in self.tracks if track.misses == 0]
+
+    def _update_rates(self):
+        wall, cpu, frames = self._window
+        now = time.time()
+        if now - wall >= 1.0:
+            self.fps = (self.frames - frames) / (now - wall)
+            # Process CPU time over wall time: 100% = one full core
+            self.cpu_percent = 100.0 * (time.process_time() - cpu) / (now - wall)
+            self._window = (now, time.process_time(), self.frames)
+
+    def stats(self):
+        elapsed = max(time.time() - self._started, 1e-6)
+        return {
+            'frames': self.frames,
+            'fps': round(self.fps, 1),
+            'avg_fps': round(self.frames / elapsed, 1),
+            'cpu_percent': round(self.cpu_percent, 1),
+            'avg_cpu_percent': round(100.0 * (time.process_time() - self._cpu_started) / elapsed, 1),
+            'tracks': len(self.tracks),
+            'detections': self.detections,
+            'encodings': self.encodings,
+            'detection_ratio': round(self.detections / max(self.frames, 1), 3),
+        }
+
+
+class PoolFaces:
+    """
+    detect/encode callbacks for FaceTracker.update() backed by a
+    RecognitionPool. detect() sends the frame with a detection-only plan;
+    encode() sends it again with the boxes of the tracks that still need an
+    identity, so faces that are already tracked are never re-encoded. Set
+    `buffer` to the frame's encoded bytes when they are already at hand,
+    and `decision` to a FrameGate decision to route the cascade stages.
+    """
+
+    def __init__(self, pool, planner=None, profile=None, jpeg_quality=90):
+        self.pool = pool
+        self.planner = planner
+        self.profile = profile
+        self.jpeg_quality = jpeg_quality
+        self.buffer = None
+        self.decision = None
+        self._frame_buffer = None
+
+    def detect(self, frame):
+        plan = self.planner.plan(self.profile) if self.planner is not None else {}
+        if 'stages' in plan and self.decision is not None:
+            plan['stages'] = route_stages(plan['stages'], self.decision)
+        plan['encode'] = False
+        buffer = self.buffer
+        if buffer is None:
+            ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            buffer = encoded.tobytes()
+        # Kept for encode(), which the tracker calls on the same frame
+        self._frame_buffer = buffer
+        face_locations, _, report = self.pool.recognize(buffer, plan)
+        if self.planner is not None:
+            self.planner.record(self.profile, report)
+        return face_locations
+
+    def encode(self, frame, boxes):
+        # Our own detector's boxes: encode them as given, no client-box checks
+        _, face_encodings, _ = self.pool.recognize(self._frame_buffer, {'boxes': [list(box) for box in boxes],
+                                                                         'trusted': True})
+        return list(face_encodings)
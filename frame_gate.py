@@ -0,0 +1,197 @@
+"""
+Cheap pre-filter in front of face detection.
+
+Scores a small grayscale thumbnail of each frame for motion (mean absolute
+difference against the last processed frame), sharpness (variance of the
+Laplacian) and exposure (mean brightness and contrast), then decides what
+the frame deserves:
+
+- skip:    nothing changed since the last processed frame, reuse its result
+- defer:   too blurred, wait for a sharper frame (a few frames at most)
+- enhance: dark or flat, go straight to the CLAHE stage of the cascade
+- process: a normal frame; CLAHE is left out since it would not help
+
+Scoring costs well under a millisecond at the default 160 px width.
+"""
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+GATE_WIDTH = 160
+DECISIONS = ('process', 'enhance', 'skip', 'defer')
+
+
+def gray_thumbnail(frame, width=GATE_WIDTH):
+    """Grayscale copy of a BGR (or gray) frame, at most `width` pixels wide"""
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape[:2]
+    if w > width:
+        gray = cv2.resize(gray, (width, max(1, int(round(h * width / w)))), interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def decode_thumbnail(buffer, width=GATE_WIDTH):
+    """
+    Thumbnail straight from encoded image bytes; JPEGs are decoded at a
+    quarter of their size, which is much cheaper than a full decode.
+    Returns None for undecodable bytes.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    gray = cv2.imdecode(data, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if gray is not None and gray.shape[1] < width:
+        # Small upload: the reduced decode would lose the detail blur scoring needs
+        gray = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    return gray_thumbnail(gray, width)
+
+
+def frame_scores(gray, reference=None):
+    """Brightness, contrast, sharpness and (given a reference thumbnail) motion"""
+    scores = {
+        'brightness': float(gray.mean()),
+        'contrast': float(gray.std()),
+        'sharpness': float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+    }
+    if reference is not None and reference.shape == gray.shape:
+        scores['motion'] = float(cv2.absdiff(gray, reference).mean())
+    return scores
+
+
+def route_stages(stages, decision):
+    """Cascade stages for a gate decision: CLAHE first for 'enhance', dropped otherwise"""
+    stages = list(stages)
+    if 'clahe' not in stages:
+        return stages
+    if decision == 'enhance':
+        return ['clahe'] + [name for name in stages if name != 'clahe']
+    return [name for name in stages if name != 'clahe'] or stages
+
+
+class FrameGate:
+    """Decide per frame whether detection is worth running, and how"""
+
+    def __init__(self, motion_threshold=2.0, blur_threshold=40.0, dark_threshold=60.0, contrast_threshold=20.0,
+                 max_skip=30, max_defer=5, width=GATE_WIDTH):
+        self.motion_threshold = motion_threshold     # mean abs difference (0-255) below which nothing changed
+        self.blur_threshold = blur_threshold         # Laplacian variance below which a frame is blurred
+        self.dark_threshold = dark_threshold         # mean brightness below which a frame is dark
+        self.contrast_threshold = contrast_threshold  # brightness std below which a frame is flat
+        self.max_skip = max_skip                     # process at least every max_skip + 1 frames
+        self.max_defer = max_defer
+        self.width = width
+        self.counts = {decision: 0 for decision in DECISIONS}
+        self.gate_ms = 0.0
+        self.processed_ms = 0.0
+        self.processed_frames = 0
+        self._reference = None
+        self._skipped = 0
+        self._deferred = 0
+        self._lock = threading.Lock()
+
+    def quality(self, scores):
+        """'dark', 'blurred' or 'ok' from a frame's scores alone"""
+        if scores['brightness'] < self.dark_threshold or scores['contrast'] < self.contrast_threshold:
+            # Checked first: dark frames also score as blurred
+            return 'dark'
+        if scores['sharpness'] < self.blur_threshold:
+            return 'blurred'
+        return 'ok'
+
+    def check(self, frame=None, gray=None):
+        """
+        Gate the next frame of a video stream (pass the frame or an already
+        made thumbnail). Returns (decision, scores).
+        """
+        started = time.perf_counter()
+        if gray is None:
+            gray = gray_thumbnail(frame, self.width)
+        with self._lock:
+            scores = frame_scores(gray, self._reference)
+            quality = self.quality(scores)
+            if scores.get('motion', float('inf')) < self.motion_threshold and self._skipped < self.max_skip:
+                decision = 'skip'
+                self._skipped += 1
+            elif quality == 'blurred' and self._deferred < self.max_defer:
+                decision = 'defer'
+                self._deferred += 1
+            else:
+                decision = 'enhance' if quality == 'dark' else 'process'
+                self._reference = gray
+                self._skipped = self._deferred = 0
+            self._count([decision], started)
+        return decision, scores
+
+    def assess(self, gray):
+        """
+        Gate a single uploaded frame: no skipping or deferring, only the
+        enhancement route. Returns (decision, quality, scores).
+        """
+        started = time.perf_counter()
+        scores = frame_scores(gray)
+        quality = self.quality(scores)
+        decision = 'enhance' if quality == 'dark' else 'process'
+        with self._lock:
+            self._count([decision], started)
+        return decision, quality, scores
+
+    def burst(self, grays):
+        """
+        Gate the frames of one burst. Blurred frames are deferred (dropped)
+        when the burst has a sharper one, and a frame nearly identical to an
+        earlier kept frame is skipped. Returns (decision, quality, index of
+        the kept frame it duplicates or None) per frame.
+        """
+        started = time.perf_counter()
+        qualities = [self.quality(frame_scores(gray)) for gray in grays]
+        any_sharp = any(quality != 'blurred' for quality in qualities)
+        results, kept = [], []
+        for i, (gray, quality) in enumerate(zip(grays, qualities)):
+            if quality == 'blurred' and any_sharp:
+                results.append(('defer', quality, None))
+                continue
+            duplicate = None
+            for j in kept:
+                if grays[j].shape == gray.shape and \
+                        float(cv2.absdiff(gray, grays[j]).mean()) < self.motion_threshold:
+                    duplicate = j
+                    break
+            if duplicate is not None:
+                results.append(('skip', quality, duplicate))
+                continue
+            kept.append(i)
+            results.append(('enhance' if quality == 'dark' else 'process', quality, None))
+        with self._lock:
+            self._count([decision for decision, _, _ in results], started)
+        return results
+
+    def _count(self, decisions, started):
+        for decision in decisions:
+            self.counts[decision] += 1
+        self.gate_ms += (time.perf_counter() - started) * 1000.0
+
+    def record(self, ms):
+        """Report how long a frame that passed the gate took to process"""
+        with self._lock:
+            self.processed_ms += ms
+            self.processed_frames += 1
+
+    def stats(self):
+        with self._lock:
+            frames = sum(self.counts.values())
+            mean_ms = self.processed_ms / self.processed_frames if self.processed_frames else 0.0
+            gated = self.counts['skip'] + self.counts['defer']
+            return {
+                'frames': frames,
+                'processed': self.counts['process'],
+                'enhanced': self.counts['enhance'],
+                'skipped': self.counts['skip'],
+                'deferred': self.counts['defer'],
+                'mean_processed_ms': round(mean_ms, 1),
+                'gate_ms_per_frame': round(self.gate_ms / max(frames, 1), 3),
+                # Skipped/deferred frames at the mean cost of a processed one, minus the gate itself
+                'time_saved_ms': round(max(0.0, gated * mean_ms - self.gate_ms), 1),
+            }
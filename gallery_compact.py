@@ -0,0 +1,140 @@
+"""
+Gallery compaction: drop near-duplicate encodings.
+
+register.py saves a burst of frames from a couple of seconds of video, so a
+student's encodings are often almost identical. They cost memory and match
+time without adding accuracy. Compaction keeps, per student, a diverse subset
+chosen by farthest-point sampling: start from the encoding nearest the
+student's mean, then keep adding the encoding farthest from everything kept
+until it is within `epsilon` of the kept set or `max_per_student` is reached.
+
+Dataset images are never deleted; dropped rows stay in the manifest so they
+are not re-encoded. Delete gallery.bin to rebuild the full gallery.
+
+Usage:
+    python gallery_compact.py --epsilon 0.15 --max-per-student 10 [--dry-run]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from face_matcher import FaceMatcher, distance_to_confidence
+
+
+def farthest_point_sample(vectors, epsilon=0.15, max_keep=0):
+    """Indices of a diverse subset of `vectors`; max_keep=0 means no cap"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors) == 0:
+        return []
+    centroid = vectors.mean(axis=0)
+    first = int(np.argmin(np.einsum('ij,ij->i', vectors - centroid, vectors - centroid)))
+    chosen = [first]
+    # Distance from every vector to its nearest kept vector
+    nearest = np.linalg.norm(vectors - vectors[first], axis=1)
+    limit = max_keep or len(vectors)
+    while len(chosen) < limit:
+        far = int(np.argmax(nearest))
+        if nearest[far] <= epsilon:
+            break
+        chosen.append(far)
+        np.minimum(nearest, np.linalg.norm(vectors - vectors[far], axis=1), out=nearest)
+    return sorted(chosen)
+
+
+def compaction_plan(gallery, epsilon=0.15, max_per_student=10):
+    """Gallery row indices to keep after compacting every student"""
+    rows_by_name = {}
+    for row, name in enumerate(gallery.names):
+        rows_by_name.setdefault(name, []).append(row)
+    keep = []
+    for rows in rows_by_name.values():
+        chosen = farthest_point_sample(gallery.encodings[rows], epsilon, max_per_student)
+        keep.extend(rows[i] for i in chosen)
+    return sorted(keep)
+
+
+def compact_gallery(gallery_path, gallery, epsilon=0.15, max_per_student=10):
+    """Compact the gallery in place; returns the (possibly unchanged) Gallery"""
+    from gallery_sync import keep_gallery_rows
+
+    keep = compaction_plan(gallery, epsilon, max_per_student)
+    if len(keep) == len(gallery):
+        return gallery
+    compacted = keep_gallery_rows(gallery_path, gallery, keep)
+    print(f"🔧 Compacted gallery {len(gallery)} -> {len(compacted)} encodings "
+          f"(epsilon={epsilon}, max {max_per_student or 'unlimited'} per student)")
+    return compacted
+
+
+def leave_one_out(encodings, names, rows, sample=2000, confidence_threshold=0.5, seed=0):
+    """
+    Match sampled rows of the full gallery against the gallery restricted to
+    `rows`, never against themselves. Returns accuracy and ms per face.
+    """
+    rng = np.random.default_rng(seed)
+    queries = np.arange(len(names))
+    if len(queries) > sample:
+        queries = np.sort(rng.choice(len(queries), sample, replace=False))
+    rows = np.asarray(rows, dtype=np.intp)
+    matcher = FaceMatcher(encodings[rows], [names[i] for i in rows])
+    position = {int(row): i for i, row in enumerate(rows)}
+    query_matrix = np.asarray(encodings[queries], dtype=np.float32)
+
+    started = time.perf_counter()
+    matcher.match(query_matrix, confidence_threshold)
+    ms_per_face = (time.perf_counter() - started) * 1000.0 / max(len(queries), 1)
+
+    correct = 0
+    for start in range(0, len(queries), 512):
+        block = queries[start:start + 512]
+        dists = matcher.distances(query_matrix[start:start + 512])
+        for qi, row in enumerate(block):
+            own = position.get(int(row))
+            if own is not None:
+                dists[qi, own] = np.inf
+            best = int(np.argmin(dists[qi])) if dists.shape[1] else -1
+            if best >= 0 and np.isfinite(dists[qi, best]) \
+                    and distance_to_confidence(dists[qi, best]) >= confidence_threshold \
+                    and matcher.names[best] == names[row]:
+                correct += 1
+    return {
+        'encodings': len(rows),
+        'megabytes': round(len(rows) * encodings.shape[1] * 4 / 1e6, 2),
+        'accuracy': correct / max(len(queries), 1),
+        'ms_per_face': round(ms_per_face, 4),
+    }
+
+
+def main():
+    from gallery_store import open_gallery
+
+    parser = argparse.ArgumentParser(description="Drop near-duplicate encodings from gallery.bin")
+    parser.add_argument("--gallery", default="gallery.bin")
+    parser.add_argument("--epsilon", type=float, default=0.15,
+                        help="encodings closer than this to a kept one are dropped")
+    parser.add_argument("--max-per-student", type=int, default=10, help="0 = no cap")
+    parser.add_argument("--sample", type=int, default=2000, help="faces used for leave-one-out accuracy")
+    parser.add_argument("--dry-run", action="store_true", help="report only, do not rewrite the gallery")
+    args = parser.parse_args()
+
+    gallery = open_gallery(args.gallery)
+    keep = compaction_plan(gallery, args.epsilon, args.max_per_student)
+    everything = np.arange(len(gallery))
+    before = leave_one_out(gallery.encodings, gallery.names, everything, args.sample)
+    after = leave_one_out(gallery.encodings, gallery.names, keep, args.sample)
+    print(f"ℹ️  {len(gallery.labels)} students, leave-one-out over {min(args.sample, len(gallery))} faces")
+    for label, row in (("before", before), ("after", after)):
+        print(f"   {label:>6}: {row['encodings']} encodings ({row['megabytes']} MB), "
+              f"accuracy {row['accuracy']:.3f}, {row['ms_per_face']:.4f} ms/face")
+
+    if args.dry_run or len(keep) == len(gallery):
+        print("ℹ️  Gallery not modified")
+        return
+    compact_gallery(args.gallery, gallery, args.epsilon, args.max_per_student)
+    print(f"✅ Compacted gallery saved to {args.gallery}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+On-disk face gallery store.
+
+A gallery is one file laid out as:
+
+    magic (8 bytes) | format version (uint32) | header length (uint32)
+    JSON header | padding to 64 bytes
+    float32 encodings block (count x dim)
+    int32 label id block (count)
+
+The JSON header carries the unique student names (ids index into it) and the
+dataset fingerprint the gallery was built from, so staleness and version
+mismatches are detected by reading a few hundred bytes. The data blocks are
+opened with np.memmap, so every worker process shares the same page-cache
+pages instead of unpickling a private copy. Files are published with a
+write-to-temp then os.replace(), so readers never see a half-written store.
+"""
+
+import json
+import os
+import struct
+from datetime import datetime
+
+import numpy as np
+
+from face_matcher import ENCODING_DIM, as_encoding_matrix
+
+GALLERY_MAGIC = b"FRGALLRY"
+GALLERY_VERSION = 1
+_PREAMBLE = struct.Struct("<8sII")
+_ALIGN = 64
+
+
+class GalleryStoreError(Exception):
+    """Raised when a gallery file is missing, corrupt or of another version"""
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def write_gallery(path, encodings, names, dataset_mtime=0.0, extra=None):
+    """Atomically publish encodings and their per-row names to `path`"""
+    matrix = as_encoding_matrix(encodings)
+    if len(matrix) != len(names):
+        raise ValueError(f"Got {len(matrix)} encodings but {len(names)} names")
+
+    labels = []
+    label_index = {}
+    ids = np.empty(len(names), dtype=np.int32)
+    for i, name in enumerate(names):
+        if name not in label_index:
+            label_index[name] = len(labels)
+            labels.append(name)
+        ids[i] = label_index[name]
+
+    header = {
+        'version': GALLERY_VERSION,
+        'dim': ENCODING_DIM,
+        'count': int(len(matrix)),
+        'dtype': 'float32',
+        'labels': labels,
+        'dataset_mtime': float(dataset_mtime),
+        'created': datetime.now().isoformat(),
+    }
+    if extra:
+        header.update(extra)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_offset = _aligned(_PREAMBLE.size + len(header_bytes))
+
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_PREAMBLE.pack(GALLERY_MAGIC, GALLERY_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b"\0" * (data_offset - _PREAMBLE.size - len(header_bytes)))
+            f.write(matrix.tobytes())
+            f.write(ids.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # Readers that already mapped the old file keep their inode
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_gallery_header(path):
+    """Return (header, data_offset) without touching the encoding block"""
+    try:
+        with open(path, 'rb') as f:
+            preamble = f.read(_PREAMBLE.size)
+            if len(preamble) < _PREAMBLE.size:
+                raise GalleryStoreError(f"{path} is truncated")
+            magic, version, header_len = _PREAMBLE.unpack(preamble)
+            if magic != GALLERY_MAGIC:
+                raise GalleryStoreError(f"{path} is not a gallery file")
+            if version != GALLERY_VERSION:
+                raise GalleryStoreError(f"{path} has version {version}, expected {GALLERY_VERSION}")
+            header = json.loads(f.read(header_len).decode('utf-8'))
+    except OSError as e:
+        raise GalleryStoreError(f"Could not read {path}: {e}")
+    except ValueError as e:
+        raise GalleryStoreError(f"Corrupt header in {path}: {e}")
+    if header.get('dim') != ENCODING_DIM:
+        raise GalleryStoreError(f"{path} has dim {header.get('dim')}, expected {ENCODING_DIM}")
+    return header, _aligned(_PREAMBLE.size + header_len)
+
+
+class Gallery:
+    """A read-only, memory-mapped gallery"""
+
+    def __init__(self, path, header, encodings, ids):
+        self.path = path
+        self.header = header
+        self.encodings = encodings
+        self.ids = ids
+        self.labels = header['labels']
+        self.names = [self.labels[i] for i in ids]
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def dataset_mtime(self):
+        return self.header.get('dataset_mtime', 0.0)
+
+
+def open_gallery(path):
+    """Map a gallery file; raises GalleryStoreError if it is unusable"""
+    header, offset = read_gallery_header(path)
+    count = header['count']
+    expected = offset + count * ENCODING_DIM * 4 + count * 4
+    if os.path.getsize(path) < expected:
+        raise GalleryStoreError(f"{path} is truncated")
+    if count == 0:
+        return Gallery(path, header, np.empty((0, ENCODING_DIM), dtype=np.float32), np.empty(0, dtype=np.int32))
+    encodings = np.memmap(path, dtype=np.float32, mode='r', offset=offset, shape=(count, ENCODING_DIM))
+    ids = np.memmap(path, dtype=np.int32, mode='r', offset=offset + count * ENCODING_DIM * 4, shape=(count,))
+    return Gallery(path, header, encodings, ids)
+
+
+def is_gallery_fresh(path, dataset_mtime):
+    """True if `path` is a readable gallery built at or after `dataset_mtime`"""
+    try:
+        header, _ = read_gallery_header(path)
+    except GalleryStoreError:
+        return False
+    return header.get('dataset_mtime', 0.0) >= dataset_mtime
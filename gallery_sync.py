@@ -0,0 +1,321 @@
+"""
+Incremental dataset -> gallery synchronisation.
+
+The gallery header keeps a manifest of every dataset image it was built from
+(relative path, size, mtime and content hash) plus the source image of every
+encoding row. A sync only encodes images that are new or whose content
+changed, drops rows of deleted images and reuses everything else, so adding
+one photo costs one encode instead of a full rebuild.
+
+OpenCV and face_recognition are imported by encode_image_file() only, so
+scanning and manifest bookkeeping do not load dlib; callers such as the web
+app hand the actual encoding to worker processes (see `encoder`).
+"""
+
+import hashlib
+import os
+import time
+
+import numpy as np
+
+from face_matcher import ENCODING_DIM
+from gallery_store import GalleryStoreError, open_gallery, write_gallery
+
+VALID_EXTS = {".jpg", ".jpeg", ".png"}
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_dataset(dataset_path="dataset"):
+    """Return {relpath: (size, mtime_ns)} for every student image"""
+    images = {}
+    try:
+        student_entries = list(os.scandir(dataset_path))
+    except OSError:
+        return images
+    for student_entry in student_entries:
+        if not student_entry.is_dir():
+            continue
+        try:
+            file_entries = list(os.scandir(student_entry.path))
+        except OSError:
+            continue
+        for entry in file_entries:
+            if os.path.splitext(entry.name)[1].lower() not in VALID_EXTS or not entry.is_file():
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            # Forward slashes so the manifest is portable across OSes
+            images[f"{student_entry.name}/{entry.name}"] = (st.st_size, st.st_mtime_ns)
+    return images
+
+
+def listing_mtime(listing):
+    """Latest image mtime (seconds) of a scan_dataset() listing"""
+    return max((mtime_ns for _, mtime_ns in listing.values()), default=0) / 1e9
+
+
+def stale_images(gallery, listing):
+    """
+    Compare a gallery's manifest with a scan_dataset() listing by size and
+    mtime only (no hashing). Returns (new or changed relpaths, removed relpaths).
+    """
+    manifest = gallery.header.get('images', {})
+    changed = [relpath for relpath, (size, mtime_ns) in sorted(listing.items())
+               if relpath not in manifest or manifest[relpath]['size'] != size
+               or manifest[relpath]['mtime_ns'] != mtime_ns]
+    removed = [relpath for relpath in sorted(manifest) if relpath not in listing]
+    return changed, removed
+
+
+def encode_image_file(img_path):
+    """Detect the largest face in an image and return its encoding, or None"""
+    import cv2
+    import face_recognition
+
+    img = cv2.imread(img_path)
+    if img is None:
+        return None
+
+    # Resize large images for better processing
+    height, width = img.shape[:2]
+    if max(height, width) > 1280:
+        scale = 1280 / max(height, width)
+        img = cv2.resize(img, (int(width * scale), int(height * scale)))
+
+    rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    # Try multiple face detection strategies
+    face_locations = face_recognition.face_locations(rgb_img, model="hog", number_of_times_to_upsample=1)
+    if len(face_locations) == 0:
+        face_locations = face_recognition.face_locations(rgb_img, model="hog", number_of_times_to_upsample=2)
+    if len(face_locations) == 0:
+        try:
+            face_locations = face_recognition.face_locations(rgb_img, model="cnn", number_of_times_to_upsample=0)
+        except Exception:
+            face_locations = []
+    if len(face_locations) == 0:
+        return None
+
+    # If multiple faces, use the largest one
+    if len(face_locations) > 1:
+        def face_area(face_location):
+            top, right, bottom, left = face_location
+            return (bottom - top) * (right - left)
+        face_locations = [max(face_locations, key=face_area)]
+
+    encodings = face_recognition.face_encodings(rgb_img, face_locations)
+    return encodings[0] if len(encodings) > 0 else None
+
+
+def _previous_rows(previous):
+    """Map relpath -> list of row indices in a previous gallery"""
+    rows = {}
+    if previous is None:
+        return rows
+    for i, relpath in enumerate(previous.header.get('row_images', [])):
+        rows.setdefault(relpath, []).append(i)
+    return rows
+
+
+def encode_job(img_path):
+    """Process-pool entry point; never raises so one bad image cannot stop a run"""
+    try:
+        encoding = encode_image_file(img_path)
+    except Exception as e:
+        return None, str(e)
+    return (None if encoding is None else np.asarray(encoding, dtype=np.float32)), None
+
+
+def _encode_serial(jobs):
+    for relpath, img_path in jobs:
+        yield (relpath,) + encode_job(img_path)
+
+
+def _encode_parallel(jobs, workers):
+    """Fan jobs out to a process pool, keeping at most 2 per worker in flight"""
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    pending = {}
+    jobs = iter(jobs)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            while len(pending) < workers * 2:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                pending[executor.submit(encode_job, job[1])] = job[0]
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield (pending.pop(future),) + future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _publish(gallery_path, previous, kept_rows, new_rows, manifest, dataset_mtime):
+    count = len(kept_rows) + len(new_rows)
+    matrix = np.empty((count, ENCODING_DIM), dtype=np.float32)
+    row_images = []
+    for i, (relpath, old_index) in enumerate(kept_rows):
+        matrix[i] = previous.encodings[old_index]
+        row_images.append(relpath)
+    for i, (relpath, encoding) in enumerate(new_rows, start=len(kept_rows)):
+        matrix[i] = encoding
+        row_images.append(relpath)
+    # The student is the image's folder, so a renamed folder relabels its rows
+    names = [relpath.split('/', 1)[0] for relpath in row_images]
+
+    write_gallery(gallery_path, matrix, names, dataset_mtime=dataset_mtime,
+                  extra={'images': manifest, 'row_images': row_images})
+
+
+def sync_gallery(gallery_path, dataset_path="dataset", previous=None, dataset_mtime=0.0, current=None,
+                 workers=1, checkpoint_seconds=30.0, encoder=None):
+    """
+    Bring the gallery at `gallery_path` up to date with `dataset_path`,
+    encoding only new or changed images. Returns the freshly mapped Gallery.
+    `current` may pass a scan_dataset() listing that is already at hand.
+
+    With workers > 1 images are encoded in a process pool. `encoder` may
+    replace that with a callable taking [(relpath, img_path)] and yielding
+    (relpath, encoding or None, error or None), e.g. RecognitionPool's
+    encode_images. Progress is checkpointed to the gallery every
+    `checkpoint_seconds`; a checkpoint is marked stale, so an interrupted
+    run resumes where it stopped.
+    """
+    started = time.time()
+    if previous is None:
+        try:
+            previous = open_gallery(gallery_path)
+        except GalleryStoreError:
+            previous = None
+
+    old_manifest = previous.header.get('images', {}) if previous is not None else {}
+    old_rows = _previous_rows(previous)
+    # Content hash -> old relpath, so moved/renamed files are not re-encoded
+    old_by_hash = {entry['sha1']: relpath for relpath, entry in old_manifest.items()}
+
+    if current is None:
+        current = scan_dataset(dataset_path)
+    manifest = {}
+    kept_rows = []        # (relpath, old row index)
+    new_rows = []         # (relpath, encoding)
+    to_encode = {}        # relpath -> (img_path, manifest entry)
+    reused_sources = set()
+    reused = 0
+
+    for relpath in sorted(current):
+        size, mtime_ns = current[relpath]
+        old = old_manifest.get(relpath)
+        if old is not None and old['size'] == size and old['mtime_ns'] == mtime_ns:
+            manifest[relpath] = old
+            kept_rows.extend((relpath, i) for i in old_rows.get(relpath, []))
+            continue
+
+        img_path = os.path.join(dataset_path, *relpath.split('/'))
+        try:
+            sha1 = file_sha1(img_path)
+        except OSError:
+            continue
+        entry = {'size': size, 'mtime_ns': mtime_ns, 'sha1': sha1}
+
+        source = relpath if old is not None and old['sha1'] == sha1 else old_by_hash.get(sha1)
+        if source is not None:
+            # Touched or moved but same content: reuse the old rows
+            manifest[relpath] = entry
+            kept_rows.extend((relpath, i) for i in old_rows.get(source, []))
+            reused_sources.add(source)
+            reused += 1
+            continue
+        to_encode[relpath] = (img_path, entry)
+
+    dropped = len(set(old_manifest) - set(current) - reused_sources)
+
+    total = len(to_encode)
+    jobs = [(relpath, img_path) for relpath, (img_path, _) in to_encode.items()]
+    if encoder is not None:
+        results = encoder(jobs)
+    elif workers > 1 and total > 1:
+        results = _encode_parallel(jobs, workers)
+    else:
+        results = _encode_serial(jobs)
+    encoded = 0
+    encode_started = last_report = last_checkpoint = time.time()
+    try:
+        for relpath, encoding, error in results:
+            encoded += 1
+            # Only finished images enter the manifest, so a checkpoint resumes
+            # cleanly; failed ones stay out and are retried next sync
+            if error:
+                print(f"⚠️  Error processing {relpath}: {error}")
+                continue
+            manifest[relpath] = to_encode[relpath][1]
+            if encoding is not None:
+                new_rows.append((relpath, encoding))
+            else:
+                print(f"❌ No usable face in {relpath}, skipping...")
+
+            now = time.time()
+            if now - last_report >= 2.0 or encoded == total:
+                rate = encoded / max(now - encode_started, 1e-6)
+                eta = (total - encoded) / rate if rate > 0 else 0.0
+                print(f"⏳ Encoded {encoded}/{total} images ({rate:.1f} img/s, ETA {eta:.0f}s)")
+                last_report = now
+            if checkpoint_seconds and now - last_checkpoint >= checkpoint_seconds and encoded < total:
+                _publish(gallery_path, previous, kept_rows, new_rows, manifest, 0.0)
+                last_checkpoint = now
+    except KeyboardInterrupt:
+        _publish(gallery_path, previous, kept_rows, new_rows, manifest, 0.0)
+        print(f"⏸️  Interrupted after {encoded}/{total} images; progress saved, run again to resume")
+        raise
+
+    _publish(gallery_path, previous, kept_rows, new_rows, manifest, dataset_mtime)
+    gallery = open_gallery(gallery_path)
+    print(f"✅ Gallery synced in {time.time() - started:.1f}s: encoded {encoded}, reused {reused}, "
+          f"dropped {dropped} images ({len(gallery.labels)} students, {len(gallery)} encodings)")
+    return gallery
+
+
+def remove_students(gallery_path, previous, names, dataset_mtime=0.0):
+    """Drop every row and manifest entry of `names` without re-encoding anyone"""
+    names = set(names)
+    keep = lambda relpath: relpath.split('/', 1)[0] not in names
+    manifest = {relpath: entry for relpath, entry in previous.header.get('images', {}).items() if keep(relpath)}
+    kept_rows = [(relpath, i) for i, relpath in enumerate(previous.header.get('row_images', [])) if keep(relpath)]
+    _publish(gallery_path, previous, kept_rows, [], manifest, dataset_mtime)
+    return open_gallery(gallery_path)
+
+
+def rename_student(gallery_path, previous, old_name, new_name, dataset_mtime=0.0):
+    """Relabel a student's rows and manifest entries after their folder was renamed"""
+    def moved(relpath):
+        folder, _, file = relpath.partition('/')
+        return f"{new_name}/{file}" if folder == old_name else relpath
+    manifest = {moved(relpath): entry for relpath, entry in previous.header.get('images', {}).items()}
+    kept_rows = [(moved(relpath), i) for i, relpath in enumerate(previous.header.get('row_images', []))]
+    _publish(gallery_path, previous, kept_rows, [], manifest, dataset_mtime)
+    return open_gallery(gallery_path)
+
+
+def keep_gallery_rows(gallery_path, previous, rows, dataset_mtime=None):
+    """
+    Republish only the given rows of `previous`. The manifest is unchanged,
+    so images whose rows were dropped (e.g. by compaction) are not re-encoded.
+    """
+    row_images = previous.header.get('row_images', [])
+    kept_rows = [(row_images[i], i) for i in sorted(rows)]
+    if dataset_mtime is None:
+        dataset_mtime = previous.dataset_mtime
+    _publish(gallery_path, previous, kept_rows, [], previous.header.get('images', {}), dataset_mtime)
+    return open_gallery(gallery_path)
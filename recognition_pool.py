@@ -0,0 +1,324 @@
+"""
+Recognition worker pool.
+
+dlib and OpenCV are not safe to drive from many Flask threads at once, which
+is why the app used to run single-threaded and one slow HOG cascade blocked
+every page. RecognitionPool runs decoding, detection and encoding in
+dedicated worker processes, each with its own dlib state, behind a bounded
+queue. Request threads submit the encoded image bytes and wait for the
+encodings; matching stays in the web process against the shared snapshot.
+Gallery syncs encode new dataset images on the same workers
+(encode_images), so the web process never loads dlib itself.
+
+With workers=0 batches run inline in the dispatcher thread, one at a time.
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from face_matcher import ENCODING_DIM
+
+
+class PoolBusy(Exception):
+    """Raised when the recognition queue is full"""
+
+
+class InvalidImage(ValueError):
+    """Raised when uploaded bytes cannot be decoded as an image"""
+
+
+def _warm_up():
+    # Load dlib models once per worker before the first real frame: detection
+    # imports face_recognition lazily, and importing it is what loads them
+    import face_recognition
+
+    import detection  # noqa: F401
+
+    # One HOG pass on a blank image also initializes the detector itself
+    face_recognition.face_locations(np.zeros((64, 64, 3), dtype=np.uint8), number_of_times_to_upsample=0)
+    return True
+
+
+def _recognize_batch_job(items):
+    """
+    Worker entry point: decode and run the detection cascade on every
+    (buffer, plan) item (or just verify the plan's client boxes), then
+    encode all their faces in one batched dlib call. Returns a list of
+    (face_locations, encodings, cascade report) per frame (None for
+    undecodable bytes, an error message if detection failed) plus the
+    seconds spent.
+    """
+    from detection import DEFAULT_STAGES, DETECT_MIN_SIZE, client_faces, decode_image, encode_faces, run_cascade
+
+    started = time.perf_counter()
+    detections = []
+    wanted = []
+    for buffer, plan in items:
+        frame = decode_image(buffer)
+        plan = plan or {}
+        try:
+            if frame is None:
+                detections.append(None)
+            elif plan.get('chip'):
+                # An already cropped face: the whole image is the box
+                detections.append(client_faces(frame, [(0, frame.shape[1] - 1, frame.shape[0] - 1, 0)]))
+            elif plan.get('boxes') is not None:
+                detections.append(client_faces(frame, plan['boxes'], verify=not plan.get('trusted')))
+            else:
+                detections.append(run_cascade(frame, plan.get('stages', DEFAULT_STAGES), plan.get('budget_ms'),
+                                              plan.get('expected_ms'), plan.get('min_size', DETECT_MIN_SIZE)))
+        except Exception as e:
+            # One bad frame must not fail the other requests in its batch
+            detections.append(str(e))
+        # {'encode': False}: detection only (e.g. a tracker's periodic pass), encodings stay empty
+        wanted.append(plan.get('encode', True))
+    encoded = encode_faces([(detection[0], detection[1] if want else [])
+                            for detection, want in zip(detections, wanted) if isinstance(detection, tuple)])
+
+    results = []
+    encoded = iter(encoded)
+    for detection in detections:
+        if not isinstance(detection, tuple):
+            results.append(detection)
+            continue
+        encodings = np.asarray(next(encoded), dtype=np.float32).reshape(-1, ENCODING_DIM)
+        results.append((detection[1], encodings, detection[2]))
+    return results, time.perf_counter() - started
+
+
+class RecognitionPool:
+    """
+    Bounded queue of detect+encode jobs served by worker processes.
+
+    A dispatcher thread groups frames submitted by concurrent requests into
+    micro-batches: once a worker is free it takes the oldest frame, waits up
+    to max_wait_ms for up to max_batch - 1 more, and sends them as one job.
+    When every worker is busy, frames queue up and the next batch is larger.
+    """
+
+    def __init__(self, workers=2, max_queue=None, wait_seconds=2.0, max_batch=8, max_wait_ms=5.0):
+        self.workers = workers
+        self.max_queue = max_queue or max(1, workers) * 4
+        self.wait_seconds = wait_seconds   # how long a request waits for a queue slot
+        self.max_batch = max(1, max_batch)
+        self.max_wait_ms = max_wait_ms
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.batches = 0
+        self.batch_sizes = {}   # frames per batch -> number of batches
+        self.busy_seconds = 0.0
+        self.gallery_encodes = 0
+        self.started_at = time.time()
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._free_workers = threading.Semaphore(max(1, workers))
+        self._pending = queue.Queue()
+        self._lock = threading.Lock()
+        # workers=0: held while a batch or gallery image runs inline (never while idle)
+        self._inline_lock = threading.Lock()
+        self._executor = None
+        self._dispatcher = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn: fresh interpreters, no dlib/OpenCV state inherited from a threaded parent
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _start_dispatcher(self):
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name='recognition-dispatcher',
+                                                    daemon=True)
+                self._dispatcher.start()
+
+    def start(self):
+        """Spawn the workers and load their models ahead of the first request"""
+        self._start_dispatcher()
+        if self.workers > 0:
+            executor = self._get_executor()
+            for _ in range(self.workers):
+                executor.submit(_warm_up)
+            print(f"🚀 Recognition pool started with {self.workers} worker process(es), "
+                  f"batches of up to {self.max_batch} frames / {self.max_wait_ms:g} ms")
+        return self
+
+    def submit(self, buffer, plan=None):
+        """
+        Queue one encoded image with an optional detection plan (see
+        CascadePlanner.plan; {'boxes': [...]} or {'chip': True} skip
+        detection, {'encode': False} skips encoding). Returns a Future
+        resolving to (face_locations, encodings, cascade report) and raising
+        InvalidImage for bad bytes. Raises PoolBusy when the queue stays
+        full for wait_seconds.
+        """
+        if not self._slots.acquire(timeout=self.wait_seconds):
+            with self._lock:
+                self.rejected += 1
+            raise PoolBusy(f"Recognition queue full ({self.max_queue} frames)")
+        with self._lock:
+            self.submitted += 1
+            self.in_flight += 1
+        self._start_dispatcher()
+        result = Future()
+        self._pending.put(((buffer, plan), result))
+        return result
+
+    def recognize(self, buffer, plan=None, timeout=30.0):
+        """Detect and encode the faces of one encoded image, blocking"""
+        return self.submit(buffer, plan).result(timeout)
+
+    def encode_images(self, jobs):
+        """
+        gallery_sync encoder: encode dataset images [(relpath, img_path)] on
+        the worker processes, at most one image per worker in flight so
+        recognition batches keep getting their turn. Yields (relpath,
+        encoding or None, error or None). With workers=0 images are encoded
+        inline, like recognition batches.
+        """
+        from concurrent.futures import FIRST_COMPLETED, wait
+        from gallery_sync import encode_job
+
+        if self.workers <= 0:
+            for relpath, img_path in jobs:
+                # Never drive dlib from two threads: wait for any inline batch to finish
+                with self._inline_lock:
+                    result = encode_job(img_path)
+                with self._lock:
+                    self.gallery_encodes += 1
+                yield (relpath,) + result
+            return
+
+        pending = {}
+        jobs = iter(jobs)
+        while True:
+            while len(pending) < self.workers:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                try:
+                    future = self._get_executor().submit(encode_job, job[1])
+                except BrokenProcessPool:
+                    self._reset()
+                    future = self._get_executor().submit(encode_job, job[1])
+                pending[future] = job[0]
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                relpath = pending.pop(future)
+                with self._lock:
+                    self.gallery_encodes += 1
+                try:
+                    yield (relpath,) + future.result()
+                except BrokenProcessPool as e:
+                    self._reset()
+                    yield relpath, None, str(e)
+
+    def _collect(self):
+        """Block for one frame, then gather more until max_batch or max_wait_ms"""
+        batch = [self._pending.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._pending.get(timeout=remaining) if remaining > 0 else self._pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _dispatch(self):
+        while True:
+            self._free_workers.acquire()
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            with self._lock:
+                self.batches += 1
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+
+            job = Future()
+            if self.workers <= 0:
+                try:
+                    with self._inline_lock:
+                        result = _recognize_batch_job(items)
+                    job.set_result(result)
+                except Exception as e:
+                    job.set_exception(e)
+            else:
+                try:
+                    job = self._get_executor().submit(_recognize_batch_job, items)
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        self._reset()
+                    job.set_exception(e)
+            job.add_done_callback(lambda done, batch=batch: self._finish(done, batch))
+
+    def _finish(self, job, batch):
+        error = job.exception()
+        self._free_workers.release()
+        with self._lock:
+            self.in_flight -= len(batch)
+            if error is None:
+                self.completed += len(batch)
+                self.busy_seconds += job.result()[1]
+            else:
+                self.failed += len(batch)
+        for _ in batch:
+            self._slots.release()
+
+        if error is not None:
+            if isinstance(error, BrokenProcessPool):
+                self._reset()
+            for _, result in batch:
+                result.set_exception(error)
+            return
+        for (_, result), outcome in zip(batch, job.result()[0]):
+            if outcome is None:
+                result.set_exception(InvalidImage('Invalid image data'))
+            elif isinstance(outcome, str):
+                result.set_exception(RuntimeError(outcome))
+            else:
+                result.set_result(outcome)
+
+    def _reset(self):
+        """Drop a broken executor (a worker crashed); the next batch respawns it"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            print("⚠️  Recognition worker crashed; restarting pool")
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        uptime = max(time.time() - self.started_at, 1e-6)
+        in_flight = self.in_flight
+        queued = self._pending.qsize()
+        return {
+            'mode': 'processes' if self.workers > 0 else 'inline',
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'in_flight': in_flight,
+            'queued': queued,
+            'busy_workers': max(0, min(max(self.workers, 1), in_flight - queued)),
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'failed': self.failed,
+            'avg_ms': round(self.busy_seconds * 1000.0 / max(self.batches, 1), 1),
+            'utilisation': round(self.busy_seconds / (uptime * max(self.workers, 1)), 3),
+            'max_batch': self.max_batch,
+            'max_wait_ms': self.max_wait_ms,
+            'batches': self.batches,
+            'mean_batch': round(self.completed / max(self.batches, 1), 2),
+            'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            'gallery_encodes': self.gallery_encodes,
+        }
@@ -0,0 +1,113 @@
+"""
+Recent-frame result cache for repeated captures.
+
+Teachers often click Capture several times on an almost identical scene.
+Each browser session keeps a few recent frames keyed by a 64-bit difference
+hash (dHash) of the gate's grayscale thumbnail. A new frame within a small
+Hamming distance of a cached one, and whose 40x30 thumbnail barely differs,
+gets the cached recognition result without detection, encoding or matching.
+Entries are tied to the gallery snapshot generation and expire after a
+short TTL, so a reloaded gallery or a changed roster is never answered from
+the cache.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+_THUMB_SIZE = (40, 30)
+
+
+def dhash(gray, size=8):
+    """Difference hash: one bit per horizontally adjacent pixel pair of a (size+1, size) thumbnail"""
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).reshape(-1)
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class ResultCache:
+    """Per-session LRU of recent (frame hash -> recognition result) entries"""
+
+    def __init__(self, max_entries=8, max_sessions=512, max_distance=4, max_pixel_diff=4.0, ttl_seconds=60.0):
+        self.max_entries = max_entries        # per session
+        self.max_sessions = max_sessions
+        self.max_distance = max_distance      # dHash bits that may differ
+        self.max_pixel_diff = max_pixel_diff  # mean abs difference (0-255) of the 40x30 thumbnails
+        self.ttl_seconds = ttl_seconds
+        self.lookups = 0
+        self.hits = 0
+        self.invalidated = 0
+        self.saved_ms = 0.0
+        self.lookup_ms = 0.0
+        self._sessions = OrderedDict()   # scope -> OrderedDict(hash -> entry)
+        self._lock = threading.Lock()
+
+    def key(self, gray):
+        """(dHash, small thumbnail) of a grayscale frame thumbnail"""
+        return dhash(gray), cv2.resize(gray, _THUMB_SIZE, interpolation=cv2.INTER_AREA)
+
+    def lookup(self, scope, key, generation):
+        """The cached result for a near-identical frame in this scope, or None"""
+        started = time.perf_counter()
+        frame_hash, thumb = key
+        now = time.time()
+        result = None
+        with self._lock:
+            self.lookups += 1
+            entries = self._sessions.get(scope)
+            if entries is not None:
+                self._sessions.move_to_end(scope)
+                for cached_hash in list(reversed(entries)):
+                    entry_generation, cached_thumb, payload, cost_ms, stored_at = entries[cached_hash]
+                    if entry_generation != generation or now - stored_at > self.ttl_seconds:
+                        del entries[cached_hash]
+                        self.invalidated += 1
+                        continue
+                    if hamming(cached_hash, frame_hash) > self.max_distance:
+                        continue
+                    if float(cv2.absdiff(cached_thumb, thumb).mean()) > self.max_pixel_diff:
+                        continue
+                    entries.move_to_end(cached_hash)
+                    self.hits += 1
+                    self.saved_ms += cost_ms
+                    result = payload
+                    break
+            self.lookup_ms += (time.perf_counter() - started) * 1000.0
+        return result
+
+    def store(self, scope, key, generation, payload, cost_ms):
+        frame_hash, thumb = key
+        with self._lock:
+            entries = self._sessions.get(scope)
+            if entries is None:
+                entries = self._sessions[scope] = OrderedDict()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(scope)
+            entries[frame_hash] = (generation, thumb, payload, cost_ms, time.time())
+            entries.move_to_end(frame_hash)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'entries': sum(len(entries) for entries in self._sessions.values()),
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': round(self.hits / max(self.lookups, 1), 3),
+                'invalidated': self.invalidated,
+                # Pipeline time of the original requests the hits replaced, minus lookup overhead
+                'saved_ms': round(max(0.0, self.saved_ms - self.lookup_ms), 1),
+                'mean_lookup_ms': round(self.lookup_ms / max(self.lookups, 1), 3),
+                'max_distance': self.max_distance,
+                'ttl_seconds': self.ttl_seconds,
+            }
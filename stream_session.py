@@ -0,0 +1,200 @@
+"""
+Streaming attendance sessions.
+
+Instead of one request per Capture click, the page opens a session, POSTs
+downscaled JPEG frames at a modest rate and listens on a Server-Sent Events
+stream for "detected" events. Each session keeps its own FaceTracker and
+FrameGate, so faces already identified are not re-encoded and unchanged
+frames are not re-detected. Frames go through a single-slot mailbox: when
+recognition falls behind, the waiting frame is replaced by the newest one
+instead of queueing up.
+"""
+
+import json
+import queue
+import secrets
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from face_tracker import FaceTracker, PoolFaces
+from frame_gate import FrameGate
+from recognition_pool import PoolBusy
+from video_pipeline import FrameSlot, RateMeter
+
+
+class TooManySessions(Exception):
+    """Raised when the maximum number of streaming sessions is open"""
+
+
+class StreamSession:
+    """One live attendance session: its frames, tracker and event stream"""
+
+    def __init__(self, owner, class_name, fallback, pool, planner, match, max_fps=4.0, idle_timeout=30.0):
+        self.id = secrets.token_urlsafe(16)
+        self.owner = owner
+        self.class_name = class_name
+        self.fallback = fallback
+        self.match = match
+        self.max_fps = max_fps
+        self.idle_timeout = idle_timeout   # close when no frame arrives for this long
+        self.started_at = time.time()
+        self.last_frame_at = self.started_at
+        self.closed = False
+        self.close_reason = None
+        self.seen = {}            # name -> {'confidence', 'first_seen'}
+        self.invalid_frames = 0
+        self.busy_frames = 0
+        self.lag_ms = 0.0         # frame received -> processed, last frame
+
+        self.slot = FrameSlot('frame_queue')
+        self.processed = RateMeter()
+        self._events = queue.Queue(maxsize=256)
+        # Frames come at max_fps, so a full detection about once a second
+        self.tracker = FaceTracker(detect_every=max(1, int(round(max_fps))))
+        self.gate = FrameGate()
+        self.faces = PoolFaces(pool, planner, profile=class_name)
+        self._thread = threading.Thread(target=self._run, name=f'stream-{self.id[:6]}', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self.emit('ready', {'session_id': self.id, 'max_fps': self.max_fps, 'class_name': self.class_name})
+        return self
+
+    def push(self, buffer):
+        """Hand over a frame; replaces the waiting one if recognition is behind"""
+        self.last_frame_at = time.time()
+        self.slot.put((self.last_frame_at, buffer))
+
+    def close(self, reason='stopped'):
+        if not self.closed:
+            self.closed = True
+            self.close_reason = reason
+            self.emit('end', {'reason': reason, 'students': self.students()})
+
+    def emit(self, event, data):
+        try:
+            self._events.put_nowait((event, data))
+        except queue.Full:
+            # Nobody is listening: drop the oldest event rather than block recognition
+            try:
+                self._events.get_nowait()
+            except queue.Empty:
+                pass
+            self._events.put_nowait((event, data))
+
+    def events(self, keepalive_seconds=15.0):
+        """Server-Sent Events generator; ends after the 'end' event"""
+        while True:
+            try:
+                event, data = self._events.get(timeout=keepalive_seconds)
+            except queue.Empty:
+                if self.closed:
+                    return
+                yield ': keep-alive\n\n'
+                continue
+            yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+            if event == 'end':
+                return
+
+    def students(self):
+        return [{'name': name, **info} for name, info in sorted(self.seen.items(), key=lambda item: item[1]['first_seen'])]
+
+    def _run(self):
+        last_stats = time.time()
+        while not self.closed:
+            item = self.slot.take(timeout=1.0)
+            now = time.time()
+            if now - last_stats >= 2.0:
+                self.emit('stats', self.stats())
+                last_stats = now
+            if item is None:
+                if now - self.last_frame_at > self.idle_timeout:
+                    self.close('idle')
+                continue
+            received_at, buffer = item
+            try:
+                self._process(buffer)
+            except Exception as e:
+                print(f"⚠️  Stream session {self.id[:6]} failed on a frame: {e}")
+            self.lag_ms = (time.time() - received_at) * 1000.0
+
+    def _process(self, buffer):
+        frame = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            self.invalid_frames += 1
+            return
+        self.processed.tick()
+        decision, _ = self.gate.check(frame)
+        if decision in ('skip', 'defer'):
+            return
+        self.faces.decision = decision
+        # The uploaded bytes go to the pool as they are, no re-encode
+        self.faces.buffer = buffer
+        try:
+            tracks = self.tracker.update(frame, self.faces.detect, self.faces.encode, self.match)
+        except PoolBusy:
+            self.busy_frames += 1
+            return
+        for track in tracks:
+            if track.name is None or track.name in self.seen:
+                continue
+            self.seen[track.name] = {'confidence': round(float(track.confidence), 3),
+                                     'first_seen': round(time.time() - self.started_at, 1)}
+            self.emit('detected', {'name': track.name, **self.seen[track.name]})
+
+    def stats(self):
+        return {
+            'session_id': self.id,
+            'class_name': self.class_name,
+            'age_seconds': round(time.time() - self.started_at, 1),
+            'students': len(self.seen),
+            'processed_fps': round(self.processed.rate(), 1),
+            'lag_ms': round(self.lag_ms, 1),
+            'frames': self.slot.stats(),
+            'invalid_frames': self.invalid_frames,
+            'pool_busy_frames': self.busy_frames,
+            'tracking': self.tracker.stats(),
+            'gate': self.gate.stats(),
+        }
+
+
+class StreamRegistry:
+    """Open streaming sessions by id, with a cap on how many run at once"""
+
+    def __init__(self, max_sessions=8):
+        self.max_sessions = max_sessions
+        self.opened = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def open(self, **kwargs):
+        with self._lock:
+            # Closed sessions (stopped or idle) make room first
+            for session_id in [sid for sid, s in self._sessions.items() if s.closed]:
+                del self._sessions[session_id]
+            if len(self._sessions) >= self.max_sessions:
+                raise TooManySessions(f"At most {self.max_sessions} streaming sessions at once")
+            stream = StreamSession(**kwargs)
+            self._sessions[stream.id] = stream
+            self.opened += 1
+        return stream.start()
+
+    def get(self, session_id, owner):
+        """The session if it exists and belongs to `owner`, else None"""
+        stream = self._sessions.get(session_id)
+        if stream is None or stream.owner != owner:
+            return None
+        return stream
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            'max_sessions': self.max_sessions,
+            'opened': self.opened,
+            'active': sum(not s.closed for s in sessions),
+            'sessions': [s.stats() for s in sessions if not s.closed],
+        }
@@ -0,0 +1,190 @@
+"""
+Capture / recognition / display pipeline for live video.
+
+Reading the camera, recognizing faces and drawing used to share one loop,
+so while recognition was busy the driver buffered frames and everything on
+screen fell further behind. Here a capture thread reads continuously and
+keeps only the newest frame for each consumer (older unread frames are
+dropped, not queued), a recognition thread works on the newest frame at its
+own rate, and the display loop draws the last known annotations on every
+captured frame.
+"""
+
+import os
+import threading
+import time
+
+import cv2
+
+
+class RateMeter:
+    """Events per second over the last completed window"""
+
+    def __init__(self, window=1.0):
+        self.window = window
+        self.total = 0
+        self._count = 0
+        self._start = time.time()
+        self._rate = 0.0
+
+    def tick(self, n=1):
+        self.total += n
+        self._count += n
+        now = time.time()
+        if now - self._start >= self.window:
+            self._rate = self._count / (now - self._start)
+            self._start, self._count = now, 0
+
+    def rate(self):
+        elapsed = time.time() - self._start
+        if elapsed >= 2 * self.window:
+            # No tick closed a window lately: the rate has dropped
+            return self._count / elapsed
+        return self._rate
+
+
+class FrameSlot:
+    """Single-slot mailbox: put() replaces an unread frame, which counts as dropped"""
+
+    def __init__(self, name):
+        self.name = name
+        self._cond = threading.Condition()
+        self._item = None
+        self.received = 0
+        self.drops = RateMeter()
+
+    def put(self, item):
+        with self._cond:
+            if self._item is not None:
+                self.drops.tick()
+            self._item = item
+            self.received += 1
+            self._cond.notify_all()
+
+    def take(self, timeout=None):
+        """Wait up to timeout for an unread frame and remove it; None if there was none"""
+        with self._cond:
+            if self._item is None:
+                self._cond.wait(timeout)
+            item, self._item = self._item, None
+            return item
+
+    def qsize(self):
+        return 0 if self._item is None else 1
+
+    def stats(self):
+        return {
+            'queue': self.qsize(),
+            'received': self.received,
+            'dropped': self.drops.total,
+            'dropped_per_second': round(self.drops.rate(), 1),
+        }
+
+
+def open_source(source):
+    """
+    Open a camera index ("0"), a video file or a stream URL (rtsp://,
+    http://). Returns (cv2.VideoCapture, pace_fps): files are replayed at
+    their own frame rate so they stand in for a live camera.
+    """
+    source = str(source)
+    if source.isdigit():
+        return cv2.VideoCapture(int(source)), None
+    capture = cv2.VideoCapture(source)
+    pace_fps = None
+    if os.path.exists(source):
+        pace_fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    return capture, pace_fps
+
+
+class CaptureThread(threading.Thread):
+    """Read frames from a cv2.VideoCapture as fast as it delivers them (or at pace_fps)"""
+
+    def __init__(self, capture, slots, name='capture', pace_fps=None):
+        super().__init__(name=name, daemon=True)
+        self.capture = capture
+        self.slots = slots
+        self.pace_fps = pace_fps
+        self.fps = RateMeter()
+        self.ended = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        seq = 0
+        started = time.time()
+        while not self._stop_event.is_set():
+            ret, frame = self.capture.read()
+            if not ret:
+                break
+            seq += 1
+            if self.pace_fps:
+                delay = started + seq / self.pace_fps - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.fps.tick()
+            item = (seq, time.time(), frame)
+            for slot in self.slots:
+                slot.put(item)
+        self.ended = True
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class RecognitionThread(threading.Thread):
+    """
+    Run process(frame) on the newest captured frame and keep the last
+    result; process() may return None to leave the previous result in place
+    """
+
+    def __init__(self, slot, process, name='recognition'):
+        super().__init__(name=name, daemon=True)
+        self.slot = slot
+        self.process = process
+        self.result = None          # (frame seq, captured at, process() result)
+        self.fps = RateMeter()
+        self.lag_ms = 0.0           # capture -> result available, last frame
+        self.busy_ms = 0.0
+        self.errors = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            item = self.slot.take(timeout=0.5)
+            if item is None:
+                continue
+            seq, captured_at, frame = item
+            started = time.time()
+            try:
+                result = self.process(frame)
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠️  Recognition failed on frame {seq}: {e}")
+                continue
+            now = time.time()
+            self.busy_ms = (now - started) * 1000.0
+            self.fps.tick()
+            if result is None:
+                # Frame gated out: the previous annotations still stand
+                continue
+            self.result = (seq, captured_at, result)
+            self.lag_ms = (now - captured_at) * 1000.0
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def pipeline_stats(capture, recognizer, slots, display_fps=None):
+    """One dict describing every stage, for logging or an overlay"""
+    stats = {
+        'capture_fps': round(capture.fps.rate(), 1),
+        'recognition_fps': round(recognizer.fps.rate(), 1),
+        'recognition_ms': round(recognizer.busy_ms, 1),
+        'lag_ms': round(recognizer.lag_ms, 1),
+        'recognition_errors': recognizer.errors,
+    }
+    if display_fps is not None:
+        stats['display_fps'] = round(display_fps.rate(), 1)
+    for slot in slots:
+        stats[slot.name] = slot.stats()
+    return stats
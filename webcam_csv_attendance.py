@@ -1,146 +1,207 @@
+import argparse
 import cv2
-import face_recognition
-import numpy as np
 import os
 import csv
+import threading
+import time
 from datetime import datetime
+from face_matcher import FaceMatcher
+from gallery_store import GalleryStoreError, open_gallery
+from gallery_sync import listing_mtime, scan_dataset, stale_images, sync_gallery
+from face_tracker import FaceTracker, PoolFaces
+from frame_gate import FrameGate
+from detection import CascadePlanner
+from recognition_pool import PoolBusy, RecognitionPool
+from video_pipeline import CaptureThread, FrameSlot, RateMeter, RecognitionThread, open_source, pipeline_stats
 
-# --- Load encodings from dataset with improved accuracy ---
-dataset_path = "dataset"
-
-known_encodings = []
-known_names = []
-student_encodings = {}  # Store multiple encodings per student
-
-for student_name in os.listdir(dataset_path):
-    student_folder = os.path.join(dataset_path, student_name)
-    
-    if not os.path.isdir(student_folder):
-        continue
-    
-    student_encodings[student_name] = []
-    
-    # Process all images for each student
-    for file in os.listdir(student_folder):
-        if file.endswith(".jpg") or file.endswith(".png"):
-            img_path = os.path.join(student_folder, file)
-            img = cv2.imread(img_path)
-            if img is None:
-                continue
-            
-            # Resize large images for better processing
-            height, width = img.shape[:2]
-            if max(height, width) > 1280:
-                scale = 1280 / max(height, width)
-                new_width = int(width * scale)
-                new_height = int(height * scale)
-                img = cv2.resize(img, (new_width, new_height))
-            
-            rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            
-            # Try multiple face detection strategies
-            face_locations = face_recognition.face_locations(rgb_img, model="hog")
-            if len(face_locations) == 0:
-                # Try with upsampling for small faces
-                face_locations = face_recognition.face_locations(rgb_img, model="hog", number_of_times_to_upsample=1)
-            
-            if len(face_locations) > 0:
-                # If multiple faces, use the largest one
-                if len(face_locations) > 1:
-                    def face_area(face_location):
-                        top, right, bottom, left = face_location
-                        return (bottom - top) * (right - left)
-                    face_locations = [max(face_locations, key=face_area)]
-                
-                encodings = face_recognition.face_encodings(rgb_img, face_locations)
-                if len(encodings) > 0:
-                    student_encodings[student_name].append(encodings[0])
-
-# Add all encodings to the main lists
-for student_name, encodings in student_encodings.items():
-    if encodings:  # Only add if we have at least one encoding
-        for encoding in encodings:
-            known_encodings.append(encoding)
-            known_names.append(student_name)
-
-print(f"✅ Loaded {len(set(known_names))} students with {len(known_encodings)} total encodings")
-
-# Improved face recognition with confidence scoring
-def recognize_face_with_confidence(face_encoding, known_encodings, known_names, confidence_threshold=0.6):
+# Recognition runs on quarter-size frames: one HOG pass at 2x (as the
+# original per-frame face_locations call did), CLAHE only for dark frames
+WEBCAM_STAGES = ('hog', 'clahe')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Webcam attendance to a daily CSV")
+    parser.add_argument("--source", action="append", default=None,
+                        help="camera index, video file or stream URL; repeat for several cameras (default: 0)")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="recognition worker processes shared by all cameras (0 = run inline)")
+    parser.add_argument("--gallery", default="gallery.bin", help="persisted gallery to start from")
+    parser.add_argument("--encode-workers", type=int, default=os.cpu_count() or 1,
+                        help="processes for encoding new/changed dataset images at startup")
+    parser.add_argument("--detect-every", type=int, default=10,
+                        help="run full face detection every N frames (sooner on motion); tracks are followed in between")
+    parser.add_argument("--motion-threshold", type=float, default=12.0,
+                        help="mean frame difference (0-255) that forces a detection")
+    parser.add_argument("--no-tracking", action="store_true", help="detect and encode on every frame")
+    parser.add_argument("--no-gate", action="store_true",
+                        help="do not skip unchanged/blurred frames or route dark frames to enhancement")
+    parser.add_argument("--no-display", action="store_true", help="run headless (no preview windows)")
+    parser.add_argument("--stats-every", type=float, default=10.0,
+                        help="print per-camera FPS/lag/drops every N seconds (0 = off)")
+    return parser.parse_args()
+
+
+# --- Gallery: the one encode_faces.py / the web app persist ---
+def load_gallery(dataset_path="dataset", gallery_path="gallery.bin", workers=1):
     """
-    Recognize a face with confidence scoring
-    Returns (name, confidence) or (None, 0) if below threshold
+    Map the persisted gallery and check it against the dataset by file size
+    and mtime; only new or changed images are encoded (and removed ones
+    dropped) before the cameras start.
     """
-    if len(known_encodings) == 0:
-        return None, 0
-    
-    # Calculate face distances
-    face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-    
-    # Find the best match
-    best_match_index = np.argmin(face_distances)
-    best_distance = face_distances[best_match_index]
-    
-    # Convert distance to confidence (0-1 scale, higher is better)
-    confidence = max(0, 1 - (best_distance / 0.6))
-    
-    if confidence >= confidence_threshold:
-        return known_names[best_match_index], confidence
+    started = time.time()
+    listing = scan_dataset(dataset_path)
+    try:
+        gallery = open_gallery(gallery_path)
+    except GalleryStoreError as e:
+        print(f"ℹ️  No usable gallery yet: {e}")
+        gallery = None
+
+    # dataset_mtime 0 marks a checkpoint of an interrupted sync
+    if gallery is not None and gallery.dataset_mtime > 0 and stale_images(gallery, listing) == ([], []):
+        print(f"✅ Mapped gallery {gallery_path} ({len(gallery.labels)} students, {len(gallery)} encodings) "
+              f"in {time.time() - started:.2f}s")
     else:
-        return None, confidence
-
-# --- Attendance CSV setup ---
-today_date = datetime.now().strftime("%Y-%m-%d")
-csv_filename = f"attendance_{today_date}.csv"
-
-if not os.path.exists(csv_filename):
-    with open(csv_filename, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["Name", "Time"])  # header row
-
-# --- Webcam recognition loop ---
-video_capture = cv2.VideoCapture(0)
-attendance_marked = set()  # keep track to avoid duplicate marking
-
-print("📸 Starting camera... Press 'q' to quit")
-
-while True:
-    ret, frame = video_capture.read()
-    if not ret:
-        break
-    
-    # Check for quit key FIRST, before processing faces
-    key = cv2.waitKey(1)
-    if key == ord("q") or key == 27:   # 27 = ESC key
-        break
-    
-    # Resize frame for speed
-    small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-    rgb_small = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
-
-    # Detect faces
-    face_locations = face_recognition.face_locations(rgb_small)
-    face_encodings = face_recognition.face_encodings(rgb_small, face_locations)
-
-    for face_encoding, face_location in zip(face_encodings, face_locations):
-        # Use improved recognition with confidence scoring
-        name, confidence = recognize_face_with_confidence(face_encoding, known_encodings, known_names, confidence_threshold=0.6)
-        
-        if name is None:
-            name = "Unknown"
-            confidence = 0
-
-        # Mark attendance if not already done and confidence is high enough
-        if name != "Unknown" and name not in attendance_marked:
-            with open(csv_filename, "a", newline="") as f:
+        if gallery is not None:
+            changed, removed = stale_images(gallery, listing)
+            print(f"🔧 Gallery is stale: {len(changed)} new/changed and {len(removed)} removed images")
+        gallery = sync_gallery(gallery_path, dataset_path=dataset_path, previous=gallery,
+                               dataset_mtime=listing_mtime(listing), current=listing, workers=workers)
+
+    # Gallery as one float32 matrix, matched once per frame
+    return FaceMatcher(gallery.encodings, gallery.names)
+
+
+class AttendanceLog:
+    """Today's attendance CSV, shared by every camera: each student is marked once"""
+
+    def __init__(self):
+        today_date = datetime.now().strftime("%Y-%m-%d")
+        self.csv_filename = f"attendance_{today_date}.csv"
+        self.marked = set()
+        self._lock = threading.Lock()
+
+        if not os.path.exists(self.csv_filename):
+            with open(self.csv_filename, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["Name", "Time"])  # header row
+
+    def mark(self, name, confidence, camera):
+        """Returns True if this call marked the student"""
+        with self._lock:
+            if name in self.marked:
+                return False
+            with open(self.csv_filename, "a", newline="") as f:
                 writer = csv.writer(f)
                 writer.writerow([name, datetime.now().strftime("%H:%M:%S")])
-            attendance_marked.add(name)
-            print(f"✅ Attendance marked for {name} (confidence: {confidence:.2f})")
+            self.marked.add(name)
+        print(f"✅ Attendance marked for {name} on {camera} (confidence: {confidence:.2f})")
+        return True
+
+
+class Camera:
+    """
+    One video source: its capture thread and a recognition thread that gates
+    and tracks its frames. Detection and encoding go to the shared pool.
+    """
+
+    def __init__(self, name, source, args, pool, planner, matcher, attendance):
+        self.name = name
+        self.source = source
+        self.args = args
+        self.matcher = matcher
+        self.attendance = attendance
+        self.marked = 0
+        self.busy_frames = 0
+
+        self.capture_device, pace_fps = open_source(source)
+        if not self.capture_device.isOpened():
+            raise RuntimeError(f"Could not open video source {source!r}")
+        # Tracks are followed with optical flow between detections, and only
+        # new or reacquired faces are encoded
+        self.tracker = FaceTracker(detect_every=1 if args.no_tracking else args.detect_every,
+                                   motion_threshold=args.motion_threshold)
+        # Skips unchanged frames, defers blurred ones and routes dark ones to CLAHE
+        self.gate = FrameGate()
+        # One pool job detects and encodes every face; the cascade planner learns per camera
+        self.faces = PoolFaces(pool, planner, profile=name)
+
+        # Capture keeps only the newest frame per stage; recognition runs at
+        # its own rate and the display redraws the last annotations
+        self.recognition_slot = FrameSlot("recognition_queue")
+        self.display_slot = FrameSlot("display_queue")
+        self.capture = CaptureThread(self.capture_device, [self.recognition_slot, self.display_slot],
+                                     name=f"capture-{name}", pace_fps=pace_fps)
+        self.recognizer = RecognitionThread(self.recognition_slot, self.recognize, name=f"recognition-{name}")
+        self.display_fps = RateMeter()
+
+    def start(self):
+        self.capture.start()
+        self.recognizer.start()
+        return self
+
+    def stop(self):
+        self.capture.stop()
+        self.recognizer.stop()
+        self.capture.join(timeout=2.0)
+        self.recognizer.join(timeout=5.0)
+        self.capture_device.release()
+
+    def match(self, encodings):
+        return self.matcher.match(encodings, confidence_threshold=0.6)
 
-        # Draw box around face with color based on confidence
-        top, right, bottom, left = [v * 4 for v in face_location]  # scale back
-        
+    def recognize(self, frame):
+        """
+        Recognition stage: track/recognize faces, mark attendance, return what
+        to draw (None keeps the previous annotations for a gated frame)
+        """
+        # Resize frame for speed
+        small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
+
+        if not self.args.no_gate:
+            self.faces.decision, _ = self.gate.check(small_frame)
+            if self.faces.decision in ('skip', 'defer'):
+                return None
+        started = time.perf_counter()
+
+        # Detect (periodically / on motion), track in between, encode new faces only
+        if self.args.no_tracking:
+            # Baseline for comparison: forget tracks so every face is re-detected and re-encoded
+            self.tracker.tracks = []
+        try:
+            tracks = self.tracker.update(small_frame, self.faces.detect, self.faces.encode, self.match)
+        except PoolBusy:
+            # Other cameras are keeping the workers busy: drop this frame
+            self.busy_frames += 1
+            return None
+        self.gate.record((time.perf_counter() - started) * 1000.0)
+
+        annotations = []
+        for track in tracks:
+            name, confidence, face_location = track.name, track.confidence, track.int_box()
+            if name is None:
+                name = "Unknown"
+                confidence = 0
+
+            # Mark attendance once across all cameras
+            if name != "Unknown" and self.attendance.mark(name, confidence, self.name):
+                self.marked += 1
+
+            annotations.append((name, confidence, [v * 4 for v in face_location]))  # scale back
+        return annotations
+
+    def stats(self):
+        stats = pipeline_stats(self.capture, self.recognizer, [self.recognition_slot, self.display_slot],
+                               self.display_fps)
+        stats['source'] = self.source
+        stats['marked'] = self.marked
+        stats['pool_busy_frames'] = self.busy_frames
+        stats['tracking'] = self.tracker.stats()
+        stats['gate'] = self.gate.stats()
+        return stats
+
+
+def draw(frame, annotations):
+    for name, confidence, (top, right, bottom, left) in annotations:
         # Color coding: Green for high confidence, Yellow for medium, Red for low/unknown
         if confidence >= 0.8:
             color = (0, 255, 0)  # Green
@@ -148,14 +209,90 @@ while True:
             color = (0, 255, 255)  # Yellow
         else:
             color = (0, 0, 255)  # Red
-        
+
         cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
-        
+
         # Display name and confidence
         display_text = f"{name} ({confidence:.2f})" if name != "Unknown" else "Unknown"
         cv2.putText(frame, display_text, (left, top - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
 
-    cv2.imshow("Face Recognition Attendance", frame)
 
-video_capture.release()
-cv2.destroyAllWindows()
+def print_stats(cameras, pool, attendance, final=False):
+    label = "Session stats" if final else "Stats"
+    print(f"ℹ️  {label}: {len(attendance.marked)} students marked, pool {pool.stats()}")
+    for camera in cameras:
+        stats = camera.stats()
+        print(f"ℹ️    {camera.name} ({camera.source}): capture {stats['capture_fps']} fps, "
+              f"recognition {stats['recognition_fps']} fps, lag {stats['lag_ms']:.0f} ms, "
+              f"dropped {stats['recognition_queue']['dropped_per_second']}/s, marked {stats['marked']}")
+        if final:
+            print(f"ℹ️    {camera.name}: {stats}")
+
+
+def main():
+    started = time.time()
+    args = parse_args()
+    sources = args.source or ["0"]
+
+    matcher = load_gallery(gallery_path=args.gallery, workers=args.encode_workers)
+    attendance = AttendanceLog()
+    # One pool and one cascade planner (learning per camera) for every source
+    pool = RecognitionPool(workers=args.workers, max_queue=max(4, 2 * len(sources)), wait_seconds=0.5).start()
+    planner = CascadePlanner(WEBCAM_STAGES, budget_ms=800, min_size=0)
+
+    cameras = []
+    for i, source in enumerate(sources):
+        try:
+            cameras.append(Camera(f"cam{i}", source, args, pool, planner, matcher, attendance))
+        except RuntimeError as e:
+            print(f"❌ {e}")
+    if not cameras:
+        return
+
+    print(f"📸 Starting {len(cameras)} camera(s) {time.time() - started:.2f}s after launch... Press 'q' to quit")
+    for camera in cameras:
+        camera.start()
+
+    last_stats = time.time()
+    try:
+        while not all(camera.capture.ended and camera.display_slot.qsize() == 0 for camera in cameras):
+            shown = False
+            for camera in cameras:
+                item = camera.display_slot.take(timeout=0)
+                if item is None:
+                    continue
+                shown = True
+                camera.display_fps.tick()
+                if args.no_display:
+                    continue
+                _, _, frame = item
+                if camera.recognizer.result is not None:
+                    draw(frame, camera.recognizer.result[2])
+                stats = camera.stats()
+                cv2.putText(frame, f"{stats['capture_fps']:.0f} FPS  recog {stats['recognition_fps']:.1f}/s  "
+                                   f"lag {stats['lag_ms']:.0f} ms  CPU {stats['tracking']['cpu_percent']:.0f}%",
+                            (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+                cv2.imshow(f"Face Recognition Attendance - {camera.name}", frame)
+
+            if not args.no_display:
+                key = cv2.waitKey(1)
+                if key == ord("q") or key == 27:   # 27 = ESC key
+                    break
+            if not shown:
+                time.sleep(0.005)
+
+            if args.stats_every and time.time() - last_stats >= args.stats_every:
+                print_stats(cameras, pool, attendance)
+                last_stats = time.time()
+    except KeyboardInterrupt:
+        pass
+
+    for camera in cameras:
+        camera.stop()
+    if not args.no_display:
+        cv2.destroyAllWindows()
+    print_stats(cameras, pool, attendance, final=True)
+
+
+if __name__ == "__main__":
+    main()